@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from utils.profiling import peak_rss_mb
+
+# Benchmark of the preprocess and resplit stages on synthetic data (benchmarks/synthetic.py). Every stage
+# runs in a fresh interpreter so that its peak RSS is its own, and the results are written as JSON, e.g.
+#   python -m benchmarks.bench_pipeline --sizes 10000,100000,1000000 --output_path bench.json
+#   python -m benchmarks.bench_pipeline --sizes 10000,100000 --compare bench.json
+# The rdflib stage is slow, so it only parses the first --parse_limit queries.
+
+STAGES = ["generate", "extract_triples", "extract_triples_fast", "functions", "index", "data_filter", "resplit"]
+
+
+def _load_questions(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_indexed_frame(path):
+    import pandas as pd
+    from resplit import group_schema_terms
+    from utils.term_index import SchemaTermIndex
+    data = pd.DataFrame(_load_questions(path))
+    index = SchemaTermIndex.from_frame(data)
+    return group_schema_terms(data, index), index
+
+
+def run_stage(stage, data_path, num_questions, args):
+    # returns the number of rows processed and the seconds spent, excluding the loading of the input
+    if stage == "generate":
+        from benchmarks.synthetic import generate_questions, write_questions
+        start = time.perf_counter()
+        rows = write_questions(data_path, generate_questions(num_questions, args.vocabulary_size, args.zipf_exponent,
+                                                             random_seed=args.random_seed))
+        return rows, time.perf_counter() - start
+
+    if stage in ("extract_triples", "extract_triples_fast", "functions"):
+        from utils.sparql_util import get_triples_lcquad, get_functions_from_sparql
+        sparqls = [question["query"]["sparql"] for question in _load_questions(data_path)]
+        if stage == "extract_triples":
+            sparqls, func = sparqls[:args.parse_limit], get_triples_lcquad
+        elif stage == "extract_triples_fast":
+            # queries outside the fast path fall back to rdflib, as in preprocess.py
+            func = lambda sparql: get_triples_lcquad(sparql, fast=True)
+        else:
+            func = get_functions_from_sparql
+        start = time.perf_counter()
+        for sparql in sparqls:
+            func(sparql)
+        return len(sparqls), time.perf_counter() - start
+
+    if stage == "index":
+        import pandas as pd
+        from resplit import group_schema_terms
+        from utils.term_index import SchemaTermIndex
+        data = pd.DataFrame(_load_questions(data_path))
+        start = time.perf_counter()
+        group_schema_terms(data, SchemaTermIndex.from_frame(data))
+        return len(data), time.perf_counter() - start
+
+    if stage == "data_filter":
+        from resplit import data_filter
+        data, index = _load_indexed_frame(data_path)
+        train_set = data.sample(frac=.6, random_state=args.random_seed)
+        heldout_set = data.drop(train_set.index)
+        start = time.perf_counter()
+        data_filter(heldout_set, train_set, index)
+        return len(heldout_set), time.perf_counter() - start
+
+    if stage == "resplit":
+        import resplit
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            resplit.main(["--dataset_id", "bench", "--input_path", data_path, "--output_dir", output_dir,
+                          "--random_seed", str(args.random_seed)])
+            return num_questions, time.perf_counter() - start
+
+    raise ValueError(f"unknown stage: {stage}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    # prints the time ratio of every stage against the baseline, returns the number of regressions
+    base = {(r["stage"], r["num_questions"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"{'stage':<22}{'questions':>10}{'base (s)':>12}{'now (s)':>12}{'ratio':>8}{'peak RSS (MB)':>22}")
+    for r in results["results"]:
+        b = base.get((r["stage"], r["num_questions"]))
+        if b is None:
+            continue
+        ratio = r["seconds"] / b["seconds"] if b["seconds"] else float("inf")
+        flag = " <- regression" if ratio > threshold else ""
+        regressions += ratio > threshold
+        print(f"{r['stage']:<22}{r['num_questions']:>10}{b['seconds']:>12.3f}{r['seconds']:>12.3f}{ratio:>8.2f}"
+              f"{b['peak_rss_mb']:>11.0f} -> {r['peak_rss_mb']:>6.0f}{flag}")
+    return regressions
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000", type=str, help="comma separated numbers of synthetic questions.")
+    parser.add_argument("--stages", default=",".join(STAGES), type=str, help="comma separated stages to run.")
+    parser.add_argument("--vocabulary_size", default=2000, type=int, help="the number of distinct predicates.")
+    parser.add_argument("--zipf_exponent", default=1.1, type=float, help="the exponent of the Zipfian predicate distribution.")
+    parser.add_argument("--parse_limit", default=20000, type=int, help="the number of queries parsed with rdflib.")
+    parser.add_argument("--random_seed", default=42, type=int, help="random seed.")
+    parser.add_argument("--output_path", type=str, help="where to write the results as JSON.")
+    parser.add_argument("--compare", type=str, help="results of a previous run to compare against.")
+    parser.add_argument("--threshold", default=1.2, type=float, help="time ratio above which a stage counts as a regression.")
+    parser.add_argument("--data_dir", type=str, help="directory for the synthetic data, a temporary one by default.")
+    # internal: run a single stage and print its measurements
+    parser.add_argument("--stage", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--data_path", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--num_questions", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(arguments)
+
+    if args.stage:
+        rows, seconds = run_stage(args.stage, args.data_path, args.num_questions, args)
+        print(json.dumps({"stage": args.stage, "num_questions": args.num_questions, "rows": rows, "seconds": seconds,
+                          "rows_per_sec": rows / seconds if seconds else None, "peak_rss_mb": peak_rss_mb()}))
+        return 0
+
+    stages = args.stages.split(",")
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"vocabulary_size": args.vocabulary_size, "zipf_exponent": args.zipf_exponent,
+                   "parse_limit": args.parse_limit, "random_seed": args.random_seed},
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        for num_questions in [int(size) for size in args.sizes.split(",")]:
+            data_path = os.path.join(data_dir, f"synthetic_{num_questions}.json")
+            # the other stages need the data, so it is generated even when not benchmarked
+            for stage in (["generate"] if "generate" not in stages and not os.path.exists(data_path) else []) + stages:
+                command = [sys.executable, "-m", "benchmarks.bench_pipeline", "--stage", stage, "--data_path", data_path,
+                           "--num_questions", str(num_questions), "--vocabulary_size", str(args.vocabulary_size),
+                           "--zipf_exponent", str(args.zipf_exponent), "--parse_limit", str(args.parse_limit),
+                           "--random_seed", str(args.random_seed)]
+                output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                if stage in stages:
+                    results["results"].append(result)
+                    print(f"{stage:<22}{num_questions:>10} questions {result['seconds']:10.3f} s "
+                          f"{result['rows_per_sec'] or 0:12.0f} rows/s {result['peak_rss_mb']:8.0f} MB peak RSS")
+
+    if args.output_path:
+        with open(args.output_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
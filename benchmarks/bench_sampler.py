@@ -0,0 +1,74 @@
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from resplit import group_schema_terms, sample_group_splits, sample_term_splits
+from utils.term_index import SchemaTermIndex, ZERO_SHOT
+
+# Comparison of the zero-shot samplers of resplit.py (--zeroshot_sampler): how much of every candidate
+# survives zeroshot_filter and how many candidates are drawn before one reaches --sampling_ratio_zero.
+# Run from the repository root on a preprocessed data set or on synthetic questions:
+#   python -m benchmarks.bench_sampler --input_path data_dir/lcquad/data_sets.json
+#   python -m benchmarks.bench_sampler --num_questions 100000
+
+SAMPLERS = ["groups", "cooccurrence"]
+
+
+def load_data(args):
+    if args.input_path:
+        return pd.read_json(args.input_path, orient="records", lines=args.input_path.endswith(".jsonl"))
+    from benchmarks.synthetic import generate_questions
+    return pd.DataFrame(generate_questions(args.num_questions, args.vocabulary_size, random_seed=args.random_seed))
+
+
+def draw_candidates(sampler, index, groups, args):
+    rows = np.arange(len(index), dtype=np.int64)
+    if sampler == "cooccurrence":
+        return sample_term_splits(index, rows, args.sampling_ratio_zero, args.n_candidates, args.random_seed)
+    return sample_group_splits(groups, args.sampling_ratio_zero, args.n_candidates, args.random_seed, "zero-shot")
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_path", type=str, help="preprocessed data set, synthetic questions if not given.")
+    parser.add_argument("--num_questions", default=100000, type=int, help="the number of synthetic questions.")
+    parser.add_argument("--vocabulary_size", default=2000, type=int, help="the number of distinct synthetic predicates.")
+    parser.add_argument("--sampling_ratio_zero", default=.4, type=float, help="the requested ratio of zero-shot questions.")
+    parser.add_argument("--tolerance", default=.1, type=float, help="relative shortfall of the zero-shot set that is still usable.")
+    parser.add_argument("--n_candidates", default=20, type=int, help="the number of candidates drawn per sampler.")
+    parser.add_argument("--random_seed", default=42, type=int, help="random seed.")
+    args = parser.parse_args(arguments)
+
+    data = load_data(args)
+    index = SchemaTermIndex.from_frame(data)
+    groups = group_schema_terms(data, index)["schema_terms_group_idx"].to_numpy()
+    target = args.sampling_ratio_zero * len(data)
+    print(f"questions: {len(data)}, terms: {index.num_terms}, combinations: {index.num_combinations}, "
+          f"target zero-shot questions: {target:.0f}")
+    print(f"{'sampler':<14}{'candidates':>11}{'held out':>10}{'zero-shot':>11}{'discarded':>11}{'ratio':>8}"
+          f"{'first usable':>14}{'ms/candidate':>14}")
+
+    for sampler in SAMPLERS:
+        start = time.perf_counter()
+        candidates = draw_candidates(sampler, index, groups, args)
+        seconds = time.perf_counter() - start
+
+        heldout, zeroshot, first_usable = [], [], None
+        for number, (train_idx, heldout_idx) in enumerate(candidates, 1):
+            levels = index.classify(heldout_idx, index.vocabulary(train_idx))
+            heldout.append(len(heldout_idx))
+            zeroshot.append(int((levels == ZERO_SHOT).sum()))
+            if first_usable is None and zeroshot[-1] >= (1 - args.tolerance) * target:
+                first_usable = number
+
+        # averages over the candidates, the discarded questions are the ones zeroshot_filter puts back into train
+        mean_heldout, mean_zeroshot = np.mean(heldout), np.mean(zeroshot)
+        print(f"{sampler:<14}{len(candidates):>11}{mean_heldout:>10.0f}{mean_zeroshot:>11.0f}"
+              f"{mean_heldout - mean_zeroshot:>11.0f}{mean_zeroshot / len(data):>8.3f}"
+              f"{first_usable if first_usable else '> ' + str(len(candidates)):>14}"
+              f"{seconds / max(len(candidates), 1) * 1000:>14.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
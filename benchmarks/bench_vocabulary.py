@@ -0,0 +1,68 @@
+import sys
+import json
+import glob
+import argparse
+import timeit
+from functools import reduce
+import numpy as np
+import pandas as pd
+from resplit import get_single_terms
+from utils.term_index import SchemaTermIndex
+
+# Microbenchmark of the train-vocabulary construction used by resplit.py, run on the resplitted
+# LC-QuAD 2.0 questions. Run from the repository root:
+#   python -m benchmarks.bench_vocabulary --input_dir output_dir/lcquad2/new_split
+
+
+def load_questions(input_dir):
+    questions = []
+    for path in sorted(glob.glob(f"{input_dir}/*.json")):
+        questions.extend(json.load(open(path))["questions"])
+    return pd.DataFrame(questions)
+
+
+def reduce_single_terms(data):
+    # the original flattening, kept as the baseline
+    return reduce(lambda x, y: x+y, data["schema_terms"].values.tolist())
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", default="output_dir/lcquad2/new_split", type=str, help="directory with the resplitted json files.")
+    parser.add_argument("--move_ratio", default=.1, type=float, help="the ratio of rows moved between train and test.")
+    parser.add_argument("--repeat", default=5, type=int, help="the number of timing repetitions, the best one is reported.")
+    parser.add_argument("--random_seed", default=42, type=int, help="random seed.")
+    args = parser.parse_args(arguments)
+
+    data = load_questions(args.input_dir)
+    index = SchemaTermIndex.from_frame(data)
+    rng = np.random.RandomState(args.random_seed)
+    rows = rng.permutation(len(data))
+    moved, kept = np.split(rows, [int(len(rows) * args.move_ratio)])
+    train_set = data.iloc[kept]
+    moved_set = data.iloc[moved]
+    print(f"questions: {len(data)}, terms: {index.num_terms}, combinations: {index.num_combinations}, moved rows: {len(moved)}")
+
+    assert reduce_single_terms(train_set) == get_single_terms(train_set)
+    vocabulary = index.vocabulary(kept)
+    full_vocabulary = index.vocabulary(rows)
+    assert (vocabulary.copy().add(moved).term_counts == full_vocabulary.term_counts).all()
+    assert (full_vocabulary.copy().remove(moved).term_counts == vocabulary.term_counts).all()
+
+    timings = [
+        ("flatten terms (reduce)", lambda: set(reduce_single_terms(train_set))),
+        ("flatten terms (chain)", lambda: set(get_single_terms(train_set))),
+        ("vocabulary from scratch", lambda: index.vocabulary(index.positions(train_set))),
+        ("vocabulary add moved rows", lambda: vocabulary.copy().add_frame(moved_set)),
+        ("vocabulary remove moved rows", lambda: full_vocabulary.copy().remove_frame(moved_set)),
+    ]
+    for name, func in timings:
+        print(f"{name:<30} {best_of(func, args.repeat) * 1000:10.3f} ms")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
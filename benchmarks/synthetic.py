@@ -0,0 +1,93 @@
+import sys
+import argparse
+import numpy as np
+from utils.columnar import write_parquet
+from utils.json_writer import write_records
+from utils.sparql_util import get_functions_from_sparql
+
+# Generator of LC-QuAD/QALD-shaped preprocessed questions for benchmarking, without any download.
+# Predicates are drawn from a Zipfian distribution over a vocabulary of the given size and filled into
+# the query templates of LC-QuAD 1.0 plus a few QALD-style ones with COUNT, FILTER and ORDER BY.
+#   python -m benchmarks.synthetic --num_questions 100000 --output_path data_sets.json
+
+ONTOLOGY = "http://dbpedia.org/ontology/"
+PROPERTY = "http://dbpedia.org/property/"
+RESOURCE = "http://dbpedia.org/resource/"
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+# (template, number of predicates, uses a class), in the spacing of the original data sets
+TEMPLATES = [
+    ("SELECT DISTINCT ?uri WHERE { <{e0}> <{p0}> ?uri } ", 1, False),
+    ("SELECT DISTINCT ?uri WHERE {?uri <{p0}> <{e0}> } ", 1, False),
+    ("SELECT DISTINCT ?uri WHERE { ?x <{p0}> <{e0}> . ?x <{p1}> ?uri  . }", 2, False),
+    ("SELECT DISTINCT ?uri WHERE { <{e0}> <{p0}> ?x . ?x <{p1}> ?uri  . }", 2, False),
+    ("SELECT DISTINCT ?uri WHERE { <{e0}> <{p0}> ?uri. <{e1}> <{p1}> ?uri} ", 2, False),
+    ("SELECT DISTINCT ?uri WHERE { ?x <{p0}> <{e0}> . ?uri <{p1}> ?x  . ?uri <" + RDF_TYPE + "> <{c0}>}", 2, True),
+    ("SELECT DISTINCT ?uri WHERE { ?uri <{p0}> <{e0}>  . ?uri <" + RDF_TYPE + "> <{c0}>}", 1, True),
+    ("SELECT DISTINCT COUNT(?uri) WHERE { ?uri <{p0}> <{e0}>  . }", 1, False),
+    ("SELECT DISTINCT COUNT(?uri) WHERE { ?x <{p0}> <{e0}> . ?x <{p1}> ?uri  . }", 2, False),
+    ("ASK WHERE { <{e0}> <{p0}> <{e1}> }", 1, False),
+    ("SELECT DISTINCT ?uri WHERE { ?uri <" + RDF_TYPE + "> <{c0}> . ?uri <{p0}> ?n . FILTER ( ?n > 1000 ) }", 1, True),
+    ("SELECT DISTINCT ?uri WHERE { ?uri <" + RDF_TYPE + "> <{c0}> ; <{p0}> ?n } ORDER BY DESC(?n) OFFSET 0 LIMIT 1", 1, True),
+]
+
+
+def zipf_weights(size, exponent):
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return weights / weights.sum()
+
+
+def generate_questions(num_questions, vocabulary_size=2000, zipf_exponent=1.1, num_entities=100000, num_classes=200,
+                       random_seed=42):
+    rng = np.random.RandomState(random_seed)
+    predicates = [(ONTOLOGY if i % 3 else PROPERTY) + f"predicate{i}" for i in range(vocabulary_size)]
+    template_ids = rng.randint(len(TEMPLATES), size=num_questions)
+    predicate_ids = rng.choice(vocabulary_size, size=(num_questions, 2), p=zipf_weights(vocabulary_size, zipf_exponent))
+    entity_ids = rng.randint(num_entities, size=(num_questions, 2))
+    class_ids = rng.randint(num_classes, size=num_questions)
+    num_answers = rng.randint(4, size=num_questions)
+
+    for i in range(num_questions):
+        template, num_predicates, with_class = TEMPLATES[template_ids[i]]
+        used = [predicates[p] for p in predicate_ids[i, :num_predicates]]
+        sparql = template
+        for name, value in (("{p0}", used[0]), ("{p1}", used[-1]), ("{e0}", RESOURCE + f"Entity{entity_ids[i, 0]}"),
+                            ("{e1}", RESOURCE + f"Entity{entity_ids[i, 1]}"), ("{c0}", ONTOLOGY + f"Class{class_ids[i]}")):
+            sparql = sparql.replace(name, value)
+
+        # the multi-set of schema terms is what matters for resplitting, not the order rdflib yields them in
+        schema_terms = used + ([RDF_TYPE] if with_class else []) + get_functions_from_sparql(sparql)
+        bindings = [{"uri": {"type": "uri", "value": RESOURCE + f"Entity{rng.randint(num_entities)}"}} for _ in range(num_answers[i])]
+        yield {
+            "id": f"synthetic_{i}",
+            "question": [{"language": "en", "string": f"Synthetic question {i} about {used[0].rsplit('/', 1)[1]}?"}],
+            "query": {"sparql": sparql},
+            "schema_terms": schema_terms,
+            "answers": [{"head": {"vars": ["uri"]}, "results": {"bindings": bindings}}],
+        }
+
+
+def write_questions(path, questions):
+    if path.endswith(".parquet"):
+        import pandas as pd
+        return write_parquet(path, pd.DataFrame(list(questions)))
+    return write_records(path, questions, output_format="jsonl" if path.endswith(".jsonl") else "json")
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num_questions", default=10000, type=int, help="the number of questions.")
+    parser.add_argument("--vocabulary_size", default=2000, type=int, help="the number of distinct predicates.")
+    parser.add_argument("--zipf_exponent", default=1.1, type=float, help="the exponent of the Zipfian predicate distribution.")
+    parser.add_argument("--num_entities", default=100000, type=int, help="the number of distinct entities.")
+    parser.add_argument("--random_seed", default=42, type=int, help="random seed.")
+    parser.add_argument("--output_path", default="data_sets.json", type=str, help="json, jsonl or parquet file to write.")
+    args = parser.parse_args(arguments)
+
+    questions = generate_questions(args.num_questions, args.vocabulary_size, args.zipf_exponent, args.num_entities,
+                                   random_seed=args.random_seed)
+    print(f"wrote {write_questions(args.output_path, questions)} questions to {args.output_path}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
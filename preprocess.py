@@ -1,74 +1,217 @@
 import os
 import sys
+import glob
 import json
+import shutil
 import argparse
+from functools import partial
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pandas as pd
-from datasets import load_dataset
-from utils.sparql_util import get_triples_lcquad, get_triples_lcquad2, get_triples_qald, get_functions_from_sparql, formalize_for_lcquad2, add_missing_angle_brackets_lcquad2
+from utils.lazy import lazy_import
+from utils.cache import SQLiteCache, schema_terms_key, sparql_hash
+from utils.columnar import COLUMNS, ParquetRecordWriter, read_frame, read_table, write_parquet
+from utils.external_shuffle import ExternalShuffle
+from utils.json_writer import CHUNK_SIZE, OUTPUT_FORMATS, RecordWriter, frame_records, output_extension, write_records
+from utils.kb_interface import KBClient, KBQueryError
+from utils.profiling import PROFILERS, StageProfiler
+from utils.dataset_sources import get_source
+from utils.sharding import MANIFEST, ShardOutput, merge_shard_outputs, parse_shard, read_manifests, shard_mask
+
+pd = lazy_import("pandas")
+# rdflib is only loaded once a query is parsed
+sparql_util = lazy_import("utils.sparql_util")
 
 
 TASKS = ["LCQUAD", "LCQUAD2", "QALD"]
 
+# per-question answer latencies of --refresh_answers, written next to stats.txt
+ANSWER_LATENCIES = "answer_latencies.tsv"
+
+
+# number of questions whose schema terms were reused from the previous run, found in the cache or extracted,
+# and of the queries retried after formalize_for_lcquad2 or failing to parse
+extraction_stats = Counter()
+
+# stage report written with --profile
+profiler = StageProfiler()
+
+
+def _get_functions(x):
+    # the functions are precomputed for whole batches by _run_extractor
+    if "functions" in x:
+        return x["functions"]
+    return sparql_util.get_functions_from_sparql(x["query"]["sparql"])
+
 
-def _extract_schema_terms_qald(x):
+def _extract_schema_terms_qald(x, fast=False):
     terms = []
     try:
-        triples = get_triples_qald(x["query"]["sparql"])
+        triples = sparql_util.get_triples_qald(x["query"]["sparql"], fast=fast)
         for triple in triples:
             terms.append(triple[1].toPython())
     except Exception as e:
         print(e)
+        extraction_stats["parse_errors"] += 1
         return np.NAN
-    functions = get_functions_from_sparql(x["query"]["sparql"])
+    functions = _get_functions(x)
     terms.extend(functions)
     return terms
 
 
-def _extract_schema_terms_lcquad(x):
+def _extract_schema_terms_lcquad(x, fast=False):
     terms = []
     try:
-        triples = get_triples_lcquad(x["query"]["sparql"])
+        triples = sparql_util.get_triples_lcquad(x["query"]["sparql"], fast=fast)
         for triple in triples:
             terms.append(triple[1].toPython())
     except Exception as e:
         print(e)
+        extraction_stats["parse_errors"] += 1
         return np.NAN
 
-    functions = get_functions_from_sparql(x["query"]["sparql"])
+    functions = _get_functions(x)
     terms.extend(functions)
 
     return terms
 
-def _extract_schema_terms_lcquad2(x, kb):
+def _extract_schema_terms_lcquad2(x, kb, fast=False):
     terms = []
     try:
-        triples = get_triples_lcquad2(x["query"]["sparql"], kb)
+        triples = sparql_util.get_triples_lcquad2(x["query"]["sparql"], kb, fast=fast)
         for triple in triples:
             terms.append(triple[1].toPython())
     except:
+        extraction_stats["formalize_retries"] += 1
         try:
-            triples = get_triples_lcquad2(formalize_for_lcquad2(x["query"]["sparql"]), kb)
+            triples = sparql_util.get_triples_lcquad2(sparql_util.formalize_for_lcquad2(x["query"]["sparql"]), kb, fast=fast)
             for triple in triples:
                 terms.append(triple[1].toPython())
         except:
+            extraction_stats["parse_errors"] += 1
             return np.NAN
-    functions = get_functions_from_sparql(x["query"]["sparql"])
+    functions = _get_functions(x)
     terms.extend(functions)
     return terms
 
-def process_qald():
-
-    train = load_dataset("kgqa_datasets/qald/qald.py", "qald", split="train").to_pandas()[
-        ["id", "question", "query", "answers"]]
-    test = load_dataset("kgqa_datasets/qald/qald.py", "qald", split="test").to_pandas()[
-        ["id", "question", "query", "answers"]]
-
-    train["id"] = train["id"].map(lambda x: "qald_train_" + str(x))
-    test["id"] = test["id"].map(lambda x: "qald_test_" + str(x))
-
-    qald = pd.concat([train, test])
+def _extract_counted(func, x):
+    # runs in a worker process, whose counters are sent back along with the terms
+    sparql_util.fast_path_stats.clear()
+    extraction_stats.clear()
+    terms = func(x)
+    return terms, (dict(sparql_util.fast_path_stats), dict(extraction_stats))
+
+
+def _run_extractor(func, queries, workers=1):
+    # only the query is needed for the extraction, so ship that instead of the whole row. The terms only
+    # depend on the query, and query templates repeat a lot (LC-QuAD 2.0 above all), so every distinct
+    # query is extracted once and its terms copied to the duplicates.
+    positions, distinct = dict(), []
+    for query in queries:
+        if query["sparql"] not in positions:
+            positions[query["sparql"]] = len(distinct)
+            distinct.append(query)
+    extraction_stats["duplicates"] += len(queries) - len(distinct)
+
+    functions = sparql_util.get_functions_batch([query["sparql"] for query in distinct])
+    rows = [{"query": query, "functions": f} for query, f in zip(distinct, functions)]
+    if workers <= 1 or len(rows) <= 1:
+        extracted = [func(x) for x in rows]
+    else:
+        chunksize = max(1, len(rows) // (workers * 8))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(partial(_extract_counted, func), rows, chunksize=chunksize))
+        for _, (fast_counts, extraction_counts) in results:
+            sparql_util.fast_path_stats.update(fast_counts)
+            extraction_stats.update(extraction_counts)
+        extracted = [terms for terms, _ in results]
+
+    terms = [extracted[positions[query["sparql"]]] for query in queries]
+    return [list(t) if isinstance(t, list) else t for t in terms]
+
+
+def _extract_with_cache(func, queries, flavour, kb, workers, cache):
+    # the fast path yields the same terms as rdflib, so both share the cache entries
+    keys = [schema_terms_key(flavour, kb, query["sparql"]) for query in queries]
+    cached = cache.get_many(keys)
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    extraction_stats["cache_hits"] += len(keys) - len(missing)
+    extracted = _run_extractor(func, [queries[i] for i in missing], workers)
+    # failed extractions are cached as well (as null), so that they are not retried on every run
+    cache.put_many([(keys[i], None if not isinstance(terms, list) else terms) for i, terms in zip(missing, extracted)])
+    for i, terms in zip(missing, extracted):
+        cached[keys[i]] = terms
+
+    return [cached[key] for key in keys]
+
+
+def _extract_schema_terms(data, extractor, flavour, workers=1, cache=None, previous=None, **kwargs):
+    func = partial(extractor, **kwargs)
+    queries = data["query"].tolist()
+    terms = [None] * len(queries)
+    stage = profiler.get(f"{flavour}/extract")
+    counts = sparql_util.fast_path_stats + extraction_stats
+
+    todo = list(range(len(queries)))
+    if previous is not None:
+        # questions whose id and query are unchanged since the previous run keep their schema terms
+        todo = []
+        for i, (id, query) in enumerate(zip(data["id"], queries)):
+            entry = previous.get(id)
+            if entry is not None and entry[0] == sparql_hash(query["sparql"]):
+                terms[i] = entry[1]
+            else:
+                todo.append(i)
+        extraction_stats["reused"] += len(queries) - len(todo)
+    extraction_stats["extracted"] += len(todo)
+
+    with profiler.stage(stage.name, rows=len(todo)):
+        if cache is None:
+            extracted = _run_extractor(func, [queries[i] for i in todo], workers)
+        else:
+            extracted = _extract_with_cache(func, [queries[i] for i in todo], flavour, kwargs.get("kb", "dbpedia"), workers, cache)
+    for i, x in zip(todo, extracted):
+        terms[i] = x
+
+    terms = [x if isinstance(x, list) else np.NAN for x in terms]
+    stage.counts.update((sparql_util.fast_path_stats + extraction_stats) - counts)
+    stage.count("errors", sum(not isinstance(x, list) for x in terms))
+    return pd.Series(terms, index=data.index, dtype=object)
+
+
+def load_previous_schema_terms(data_dir, extensions=(".json", ".jsonl", ".parquet")):
+    # id -> (query hash, schema terms or None for a failed extraction) of the outputs of a previous run,
+    # looking for data_sets/errors in the given extensions in order
+    previous = dict()
+    for name in ("errors", "data_sets"):
+        for extension in extensions:
+            path = os.path.join(data_dir, name + extension)
+            if not os.path.exists(path):
+                continue
+            if extension == ".parquet":
+                frame = read_frame(read_table(path), ("id", "query", "schema_terms"))
+            else:
+                frame = pd.read_json(path, orient="records", lines=extension == ".jsonl")
+            if not frame.empty:
+                for id, query, terms in zip(frame["id"], frame["query"], frame["schema_terms"]):
+                    previous[id] = (sparql_hash(query["sparql"]), terms if isinstance(terms, list) else None)
+            break
+    return previous
+
+
+def _load_splits(name, config_name, columns, source=None):
+    source = source or get_source()
+    with profiler.stage(f"{name}/load") as stage:
+        train = source.load(name, config_name, "train", columns)
+        test = source.load(name, config_name, "test", columns)
+        stage.rows += len(train) + len(test)
+    return train, test
+
+
+def _prepare_qald(qald, split):
+    qald["id"] = qald["id"].map(lambda x: f"qald_{split}_" + str(x))
 
     def func(xs):
         for x in json.loads(xs):
@@ -76,69 +219,418 @@ def process_qald():
                 return [x]
 
     qald["question"] = qald["question"].map(lambda x: func(x))
-    qald["answers"] = qald.apply(lambda x: json.loads(x["answers"]), axis=1)
-    qald["schema_terms"] = qald.apply(lambda x: _extract_schema_terms_qald(x), axis=1)
-
-    errors = qald[qald['schema_terms'].isnull()]
-    qald = qald.dropna()
-
-    return qald, errors
+    qald["answers"] = qald["answers"].map(json.loads)
+    return qald
 
 
-def process_lcquad():
-
-    train = load_dataset("kgqa_datasets/lcquad_v1/lcquad_v1.py", "lcquad", split="train").to_pandas()[
-        ["_id", "corrected_question", "sparql_query"]]
-    test = load_dataset("kgqa_datasets/lcquad_v1/lcquad_v1.py", "lcquad", split="test").to_pandas()[
-        ["_id", "corrected_question", "sparql_query"]]
-
-    train["_id"] = train["_id"].map(lambda x: "lcquad_train_" + str(x))
-    test["_id"] = test["_id"].map(lambda x: "lcquad_test_" + str(x))
-
-    lcquad = pd.concat([train, test])
+def _prepare_lcquad(lcquad, split):
+    lcquad["_id"] = lcquad["_id"].map(lambda x: f"lcquad_{split}_" + str(x))
     lcquad.rename(columns={"_id": "id", "corrected_question": "question", "sparql_query": "query"}, inplace=True)
     lcquad["question"] = lcquad["question"].map(lambda x: [{"language": "en", "string": x}])
     lcquad["query"] = lcquad["query"].map(lambda x: {"sparql": x})
 
     lcquad["answers"] = ""
     lcquad["answers"] = lcquad["answers"].map(lambda x: [])
+    return lcquad
 
-    lcquad["schema_terms"] = lcquad.apply(lambda x: _extract_schema_terms_lcquad(x), axis=1)
-
-    errors = lcquad[lcquad['schema_terms'].isnull()]
-    lcquad = lcquad.dropna()
-
-    return lcquad, errors
-
-
-def process_lcquad2(kb="dbpedia"):
 
-    config_name = f"lcquad2-{kb}"
-
-    train = load_dataset("kgqa_datasets/lcquad_v2/lcquad_v2.py", config_name, split="train").to_pandas()[
-        ["uid", "question", "sparql", "answer"]]
-    test = load_dataset("kgqa_datasets/lcquad_v2/lcquad_v2.py", config_name, split="test").to_pandas()[
-        ["uid", "question", "sparql", "answer"]]
-
-    train["uid"] = train["uid"].map(lambda x: "lcquad2_train_" + str(x))
-    test["uid"] = test["uid"].map(lambda x: "lcquad2_test_" + str(x))
-
-    lcquad2 = pd.concat([train, test])
+def _prepare_lcquad2(lcquad2, split, kb="dbpedia"):
+    lcquad2["uid"] = lcquad2["uid"].map(lambda x: f"lcquad2_{split}_" + str(x))
     lcquad2.rename(columns={"uid": "id", "sparql": "query", "answer": "answers"},
                    inplace=True)
     lcquad2["question"] = lcquad2["question"].map(lambda x: [{"language": "en", "string": x}])
 
     if kb == "dbpedia":
-        lcquad2["query"] = lcquad2["query"].map(lambda x: {"sparql": add_missing_angle_brackets_lcquad2(x)})
+        lcquad2["query"] = lcquad2["query"].map(lambda x: {"sparql": sparql_util.add_missing_angle_brackets_lcquad2(x)})
     else:
         lcquad2["query"] = lcquad2["query"].map(lambda x: {"sparql": x})
+    return lcquad2
+
+
+def _split_errors(data):
+    errors = data[data['schema_terms'].isnull()]
+    return data.dropna(), errors
+
+
+def _task_spec(task, kb="dbpedia"):
+    # name, loader config, loader columns, preparation, schema term extractor and its arguments of a task
+    if task == "QALD":
+        return "qald", "qald", ["id", "question", "query", "answers"], _prepare_qald, _extract_schema_terms_qald, {}
+    if task == "LCQUAD":
+        return "lcquad", "lcquad", ["_id", "corrected_question", "sparql_query"], _prepare_lcquad, _extract_schema_terms_lcquad, {}
+    return "lcquad2", f"lcquad2-{kb}", ["uid", "question", "sparql", "answer"], partial(_prepare_lcquad2, kb=kb), \
+        _extract_schema_terms_lcquad2, {"kb": kb}
+
+
+def _select_shard(data, shard, offset=0):
+    # the questions of the shard (index, num_shards), indexed by their row in the task
+    data.index = pd.RangeIndex(offset, offset + len(data))
+    return data if shard is None else data[shard_mask(data["id"], shard)].copy()
+
+
+def _process(task, kb="dbpedia", workers=1, cache=None, fast=False, previous=None, source=None, shard=None):
+    name, config_name, columns, prepare, extractor, kwargs = _task_spec(task, kb)
+    train, test = _load_splits(name, config_name, columns, source)
+    data = pd.concat([prepare(train, "train"), prepare(test, "test")])
+    if shard is not None:
+        # the questions of the other shards are dropped before their schema terms are extracted
+        data = _select_shard(data, shard)
+    data["schema_terms"] = _extract_schema_terms(data, extractor, name, workers=workers, cache=cache,
+                                                 previous=previous, fast=fast, **kwargs)
+    return _split_errors(data)
+
+
+def process_qald(workers=1, cache=None, fast=False, previous=None, source=None):
+    return _process("QALD", workers=workers, cache=cache, fast=fast, previous=previous, source=source)
+
+
+def process_lcquad(workers=1, cache=None, fast=False, previous=None, source=None):
+    return _process("LCQUAD", workers=workers, cache=cache, fast=fast, previous=previous, source=source)
+
+
+def process_lcquad2(kb="dbpedia", workers=1, cache=None, fast=False, previous=None, source=None):
+    return _process("LCQUAD2", kb, workers, cache, fast, previous, source)
+
+
+def process_chunks(task, kb="dbpedia", workers=1, cache=None, fast=False, previous=None, source=None, chunk_size=CHUNK_SIZE,
+                   shard=None):
+    # like process_<task>, but yields the data and errors of chunk_size questions at a time, indexed by
+    # their row in the task
+    name, config_name, columns, prepare, extractor, kwargs = _task_spec(task, kb)
+    source = source or get_source()
+    offset = 0
+    for split in ("train", "test"):
+        chunks = source.load_chunks(name, config_name, split, columns, chunk_size)
+        for chunk in profiler.iterate(f"{name}/load", chunks, rows=len):
+            num_rows = len(chunk)
+            chunk = _select_shard(prepare(chunk, split), shard, offset)
+            offset += num_rows
+            chunk["schema_terms"] = _extract_schema_terms(chunk, extractor, name, workers=workers, cache=cache,
+                                                          previous=previous, fast=fast, **kwargs)
+            yield _split_errors(chunk)
+
+
+def _load_answers_checkpoint(path):
+    done = dict()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                # a line cut short by an interruption is dropped and its query run again
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                done[entry["id"]] = entry
+    return done
+
+
+def refresh_answers(data, client, checkpoint_path, batch_size=1000, done=None):
+    # replaces the answers of every question by the result of its query on the KB endpoint. Answers are
+    # appended to the checkpoint after every batch, and questions whose id and query hash are found in it
+    # (or in done, the checkpoint loaded beforehand) are not queried again. Questions whose query fails
+    # keep their previous answers. The id and latency in seconds of every refreshed question are appended
+    # to the ANSWER_LATENCIES file next to the checkpoint, "cached" instead of the latency if its response
+    # came from the client's cache and "duplicate" if its query was sent for an earlier question of the batch.
+    ids = data["id"].tolist()
+    sparqls = [query["sparql"] for query in data["query"]]
+    hashes = [sparql_hash(sparql) for sparql in sparqls]
+    answers = data["answers"].tolist()
+    stats = {"queries": len(data), "resumed": 0, "cached": 0, "duplicates": 0, "failures": [], "latencies": []}
+
+    if done is None:
+        done = _load_answers_checkpoint(checkpoint_path)
+    latencies_path = os.path.join(os.path.dirname(checkpoint_path), ANSWER_LATENCIES)
+
+    def latency_line(id, latency, source):
+        return f"{id}\t{source if latency is None else f'{latency:.6f}'}\n"
+
+    pending = []
+    with open(latencies_path, "a") as latencies_file:
+        for i, (id, query_hash) in enumerate(zip(ids, hashes)):
+            entry = done.get(id)
+            if entry is not None and entry["query_hash"] == query_hash:
+                answers[i] = entry["answers"]
+                stats["resumed"] += 1
+                latencies_file.write(latency_line(id, entry["latency"], entry.get("source", "cached")))
+            else:
+                pending.append(i)
+
+    with open(checkpoint_path, "a") as checkpoint, open(latencies_path, "a") as latencies_file:
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            # None for queries served from the cache or already sent for an earlier question of the batch
+            latencies = []
+            cache_hits = client.stats["cache_hits"]
+            responses = client.query_many([sparqls[i] for i in batch], return_exceptions=True, latencies=latencies)
+            stats["cached"] += client.stats["cache_hits"] - cache_hits
+            seen = set()
+            for i, response, latency in zip(batch, responses, latencies):
+                source = "duplicate" if sparqls[i] in seen else "cached" if latency is None else "queried"
+                seen.add(sparqls[i])
+                if isinstance(response, KBQueryError):
+                    stats["failures"].append((ids[i], str(response)))
+                    continue
+                answers[i] = [response]
+                if source == "duplicate":
+                    stats["duplicates"] += 1
+                elif source == "queried":
+                    stats["latencies"].append(latency)
+                checkpoint.write(json.dumps({"id": ids[i], "query_hash": hashes[i], "latency": latency, "source": source,
+                                             "answers": answers[i]}) + "\n")
+                latencies_file.write(latency_line(ids[i], latency, source))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            print(f"refreshed answers: {min(start + batch_size, len(pending))}/{len(pending)}, failures: {len(stats['failures'])}")
+
+    data["answers"] = answers
+    return data, stats
+
+
+def write_answer_stats(stats_file, stats):
+    latencies = np.array(stats["latencies"])
+    stats_file.write("===============ANSWERS===============\n")
+    stats_file.write(f"queries: {stats['queries']}\nqueried: {len(latencies)}\nresumed: {stats['resumed']}\ncached: {stats['cached']}\n"
+                     f"duplicates: {stats['duplicates']}\nfailures: {len(stats['failures'])}\n")
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        stats_file.write(f"latency (s): mean {latencies.mean():.4f}, p50 {p50:.4f}, p95 {p95:.4f}, p99 {p99:.4f}, max {latencies.max():.4f}\n")
+    for id, error in stats["failures"]:
+        stats_file.write(f"failed: {id}\t{error}\n")
+    stats_file.write("\n")
+
+
+def check_fast_path(paths, kb="dbpedia"):
+    extractors = {"qald": _extract_schema_terms_qald, "lcquad": _extract_schema_terms_lcquad,
+                  "lcquad2": partial(_extract_schema_terms_lcquad2, kb=kb)}
+    mismatches = 0
+    for path in paths:
+        counts = {"questions": 0, "mismatches": 0}
+        sparql_util.fast_path_stats.clear()
+        for question in json.load(open(path)):
+            flavour = question["id"].rsplit("_", 2)[0]
+            expected = extractors[flavour](question)
+            actual = extractors[flavour](question, fast=True)
+            counts["questions"] += 1
+            if not (actual == expected or (not isinstance(actual, list) and not isinstance(expected, list))):
+                counts["mismatches"] += 1
+                print(f"mismatch for {question['id']}: {expected} != {actual}")
+        print(f"{path}: {counts['questions']} questions, {sparql_util.fast_path_stats['fast']} queries on the fast path, "
+              f"{sparql_util.fast_path_stats['fallback']} fallbacks, {counts['mismatches']} mismatches")
+        mismatches += counts["mismatches"]
+    return mismatches
+
+
+def preprocess_in_memory(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path):
+    questions = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
+    error_sets = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
+    for task in tasks:
+        stats_file.write(f"==============={task}===============\n")
+        with profiler.stage(task.lower()) as stage:
+            if task == "QALD":
+                data, errors = process_qald(args.workers, cache, "QALD" in fast_tasks, previous, source)
+            elif task == "LCQUAD":
+                data, errors = process_lcquad(args.workers, cache, "LCQUAD" in fast_tasks, previous, source)
+            elif task == "LCQUAD2":
+                data, errors = process_lcquad2(args.kb_lcquad2, args.workers, cache, "LCQUAD2" in fast_tasks, previous, source)
+            else:
+                data = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
+                errors = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
+            stage.rows += len(data) + len(errors)
+            stage.count("errors", len(errors))
+        stats_file.write(f"total: {len(data) + len(errors)}\ndata: {len(data)}\nerrors: {len(errors)}\n\n")
+        questions = pd.concat([questions, data])
+        error_sets = pd.concat([error_sets, errors])
+
+    if args.refresh_answers:
+        with KBClient(args.kb_endpoint, args.kb_workers, args.kb_timeout, args.kb_retries, cache=kb_cache) as client, \
+                profiler.stage("refresh_answers", rows=len(questions)) as stage:
+            questions, answer_stats = refresh_answers(questions, client, checkpoint_path)
+            stage.counts.update(client.stats)
+            stage.count("errors", len(answer_stats["failures"]))
+        write_answer_stats(stats_file, answer_stats)
+
+    if args.shuffle:
+        questions = questions.sample(frac=1, random_state=args.random_seed)
 
-    lcquad2["schema_terms"] = lcquad2.apply(lambda x: _extract_schema_terms_lcquad2(x, kb), axis=1)
+    with profiler.stage("write", rows=len(questions) + len(error_sets)):
+        if args.output_format == "parquet":
+            write_parquet(os.path.join(args.data_dir, "data_sets.parquet"), questions)
+            write_parquet(os.path.join(args.data_dir, "errors.parquet"), error_sets)
+        else:
+            extension = output_extension(args.output_format)
+            write_records(os.path.join(args.data_dir, "data_sets" + extension), frame_records(questions), output_format=args.output_format)
+            write_records(os.path.join(args.data_dir, "errors" + extension), frame_records(error_sets), output_format=args.output_format)
+
+
+def _open_writer(path, output_format):
+    if output_format == "parquet":
+        return ParquetRecordWriter(path + ".parquet")
+    return RecordWriter(path + output_extension(output_format), output_format=output_format)
+
+
+def preprocess_streaming(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path):
+    # reads, extracts, refreshes and writes --chunk_size questions at a time. The questions are shuffled
+    # by an ExternalShuffle keyed by their ids, which is deterministic under --random_seed but yields
+    # another order than the DataFrame.sample of preprocess_in_memory.
+    data_writer = _open_writer(os.path.join(args.data_dir, "data_sets"), args.output_format)
+    errors_writer = _open_writer(os.path.join(args.data_dir, "errors"), args.output_format)
+    shuffle = ExternalShuffle(args.random_seed, args.chunk_size, dir=args.data_dir) if args.shuffle else None
+    client, done = None, None
+    answer_stats = {"queries": 0, "resumed": 0, "cached": 0, "duplicates": 0, "failures": [], "latencies": []}
+    if args.refresh_answers:
+        client = KBClient(args.kb_endpoint, args.kb_workers, args.kb_timeout, args.kb_retries, cache=kb_cache)
+        done = _load_answers_checkpoint(checkpoint_path)
 
-    errors = lcquad2[lcquad2['schema_terms'].isnull()]
-    lcquad2 = lcquad2.dropna()
+    try:
+        for task in tasks:
+            stats_file.write(f"==============={task}===============\n")
+            num_data, num_errors = 0, 0
+            with profiler.stage(task.lower()) as stage:
+                chunks = process_chunks(task, args.kb_lcquad2, args.workers, cache, task in fast_tasks, previous, source, args.chunk_size)
+                for data, errors in chunks:
+                    # in the column order of preprocess_in_memory
+                    data, errors = data[COLUMNS], errors[COLUMNS]
+                    if client is not None:
+                        with profiler.stage("refresh_answers", rows=len(data)) as refresh_stage:
+                            data, chunk_stats = refresh_answers(data, client, checkpoint_path, done=done)
+                            refresh_stage.count("errors", len(chunk_stats["failures"]))
+                        for key, value in chunk_stats.items():
+                            answer_stats[key] += value
+                    with profiler.stage("write", rows=len(data) + len(errors)):
+                        if shuffle is None:
+                            data_writer.write_many(frame_records(data))
+                        else:
+                            shuffle.add_many(data["id"], frame_records(data))
+                        errors_writer.write_many(frame_records(errors))
+                    num_data += len(data)
+                    num_errors += len(errors)
+                stage.rows += num_data + num_errors
+                stage.count("errors", num_errors)
+            stats_file.write(f"total: {num_data + num_errors}\ndata: {num_data}\nerrors: {num_errors}\n\n")
+
+        if shuffle is not None:
+            with profiler.stage("shuffle", rows=shuffle.num_records):
+                data_writer.write_many(shuffle.records())
+    finally:
+        data_writer.close()
+        errors_writer.close()
+        if shuffle is not None:
+            shuffle.close()
+        if client is not None:
+            client.close()
+
+    if client is not None:
+        profiler.get("refresh_answers").counts.update(client.stats)
+        write_answer_stats(stats_file, answer_stats)
+
+
+def _merge_answer_stats(stats, other):
+    for key in ("queries", "resumed", "cached", "duplicates"):
+        stats[key] += other[key]
+    stats["failures"].extend(other["failures"])
+    stats["latencies"].extend(other["latencies"])
+    return stats
+
+
+def preprocess_shard(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path):
+    # extracts the schema terms of the questions of --shard and writes them unshuffled as the partial
+    # outputs data_sets/errors.jsonl, together with their positions in a single-node run and a manifest
+    # with the counts of stats.txt, from which --merge assembles the outputs of the single-node run
+    index, num_shards = args.shard
+    manifest = {"shard": index, "num_shards": num_shards, "tasks": tasks, "counts": {}, "answer_stats": None}
+    client, done = None, None
+    answer_stats = {"queries": 0, "resumed": 0, "cached": 0, "duplicates": 0, "failures": [], "latencies": []}
+    if args.refresh_answers:
+        client = KBClient(args.kb_endpoint, args.kb_workers, args.kb_timeout, args.kb_retries, cache=kb_cache)
+        done = _load_answers_checkpoint(checkpoint_path)
 
-    return lcquad2, errors
+    try:
+        with ShardOutput(os.path.join(args.data_dir, "data_sets")) as data_output, \
+                ShardOutput(os.path.join(args.data_dir, "errors")) as errors_output:
+            for task_idx, task in enumerate(tasks):
+                stats_file.write(f"==============={task}===============\n")
+                num_data, num_errors = 0, 0
+                with profiler.stage(task.lower()) as stage:
+                    if args.streaming:
+                        chunks = process_chunks(task, args.kb_lcquad2, args.workers, cache, task in fast_tasks, previous, source,
+                                                args.chunk_size, args.shard)
+                    else:
+                        chunks = [_process(task, args.kb_lcquad2, args.workers, cache, task in fast_tasks, previous, source, args.shard)]
+                    for data, errors in chunks:
+                        data, errors = data[COLUMNS], errors[COLUMNS]
+                        if client is not None:
+                            with profiler.stage("refresh_answers", rows=len(data)) as refresh_stage:
+                                data, chunk_stats = refresh_answers(data, client, checkpoint_path, done=done)
+                                refresh_stage.count("errors", len(chunk_stats["failures"]))
+                            # failures are kept with their position, in which the merged stats list them
+                            rows = dict(zip(data["id"], data.index))
+                            chunk_stats["failures"] = [(task_idx, int(rows[id]), id, error) for id, error in chunk_stats["failures"]]
+                            _merge_answer_stats(answer_stats, chunk_stats)
+                        with profiler.stage("write", rows=len(data) + len(errors)):
+                            data_output.write_many(frame_records(data), task_idx, data.index)
+                            errors_output.write_many(frame_records(errors), task_idx, errors.index)
+                        num_data += len(data)
+                        num_errors += len(errors)
+                    stage.rows += num_data + num_errors
+                    stage.count("errors", num_errors)
+                stats_file.write(f"total: {num_data + num_errors}\ndata: {num_data}\nerrors: {num_errors}\n\n")
+                manifest["counts"][task] = {"data": num_data, "errors": num_errors}
+    finally:
+        if client is not None:
+            client.close()
+
+    if client is not None:
+        profiler.get("refresh_answers").counts.update(client.stats)
+        write_answer_stats(stats_file, dict(answer_stats, failures=[(id, error) for _, _, id, error in answer_stats["failures"]]))
+        manifest["answer_stats"] = answer_stats
+    with open(os.path.join(args.data_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+
+def merge_shards(args):
+    # combines the partial outputs of the --shard runs in args.merge into the data_sets, errors and
+    # stats.txt of a single-node run with the same --random_seed, --shuffle and --streaming
+    manifests = read_manifests(args.merge)
+    tasks = manifests[0]["tasks"]
+
+    with open(os.path.join(args.data_dir, "stats.txt"), "w") as stats_file:
+        for task in tasks:
+            num_data = sum(manifest["counts"][task]["data"] for manifest in manifests)
+            num_errors = sum(manifest["counts"][task]["errors"] for manifest in manifests)
+            stats_file.write(f"==============={task}===============\n")
+            stats_file.write(f"total: {num_data + num_errors}\ndata: {num_data}\nerrors: {num_errors}\n\n")
+        if manifests[0]["answer_stats"] is not None:
+            answer_stats = {"queries": 0, "resumed": 0, "cached": 0, "duplicates": 0, "failures": [], "latencies": []}
+            for manifest in manifests:
+                _merge_answer_stats(answer_stats, manifest["answer_stats"])
+            answer_stats["failures"] = [(id, error) for _, _, id, error in sorted(answer_stats["failures"], key=lambda f: f[:2])]
+            write_answer_stats(stats_file, answer_stats)
+    if manifests[0]["answer_stats"] is not None:
+        # the latencies of the shards one after the other, in the order of the shards
+        with open(os.path.join(args.data_dir, ANSWER_LATENCIES), "w") as latencies_file:
+            for _, shard_dir in sorted(zip([manifest["shard"] for manifest in manifests], args.merge)):
+                with open(os.path.join(shard_dir, ANSWER_LATENCIES)) as f:
+                    shutil.copyfileobj(f, latencies_file)
+
+    for name in ("data_sets", "errors"):
+        paths = [os.path.join(shard_dir, name) for shard_dir in args.merge]
+        records = (record for _, record in merge_shard_outputs(paths))
+        with profiler.stage("merge") as stage, _open_writer(os.path.join(args.data_dir, name), args.output_format) as writer:
+            if name == "errors" or not args.shuffle:
+                writer.write_many(records)
+            elif args.streaming:
+                # the order of preprocess_streaming only depends on the ids
+                with ExternalShuffle(args.random_seed, args.chunk_size, dir=args.data_dir) as shuffle:
+                    for record in records:
+                        shuffle.add(record["id"], record)
+                    writer.write_many(shuffle.records())
+            else:
+                # the permutation of DataFrame.sample in preprocess_in_memory only depends on the number of questions
+                records = list(records)
+                order = pd.RangeIndex(len(records)).to_series().sample(frac=1, random_state=args.random_seed)
+                writer.write_many(records[i] for i in order)
+            stage.rows += writer.num_records
+        print(f"merged {writer.num_records} questions of {len(manifests)} shards into {args.data_dir}/{name}")
 
 
 def get_tasks(task_names):
@@ -153,6 +645,14 @@ def get_tasks(task_names):
     return tasks
 
 
+def write_profile(args, arguments):
+    if args.profile:
+        report_path = os.path.join(args.data_dir, "profile.json")
+        dump_path = profiler.dump(os.path.join(args.data_dir, "profile"))
+        profiler.write(report_path, command="preprocess", arguments=arguments, profile_dump=dump_path)
+        print(f"wrote the stage report to {report_path}")
+
+
 def main(arguments):
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--tasks", type=str, default="lcquad2", help="tasks to be processed as a comma separated string.")
@@ -161,38 +661,99 @@ def main(arguments):
     parser.add_argument("-r", "--random_seed", type=int, default="42", help="random seed.")
     parser.add_argument("--kb_lcquad2", default="dbpedia")
     parser.add_argument("--kb_endpoint", type=str, help="kb endpoint")
+    parser.add_argument("--raw_dir", type=str, help="read the raw files of the original releases from <raw_dir>/<qald|lcquad|lcquad2>/ instead of running the kgqa_datasets loader scripts.")
+    parser.add_argument("--refresh_answers", "--refresh-answers", action="store_true", help="replace the answers by the results of the queries on --kb_endpoint.")
+    parser.add_argument("--kb_workers", type=int, default=32, help="number of concurrent requests to the kb endpoint.")
+    parser.add_argument("--kb_timeout", type=float, default=30, help="timeout of a kb query in seconds.")
+    parser.add_argument("--kb_retries", type=int, default=3, help="number of retries of a failed kb query.")
+    parser.add_argument("--kb_cache_path", type=str, help="keep the kb responses in a cache at this path and reuse them in later --refresh_answers runs, nothing is cached by default.")
+    parser.add_argument("--output_format", default="json", choices=OUTPUT_FORMATS + ["parquet"], help="json (indented), compact json, jsonl (one question per line) or parquet.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of processes used to extract the schema terms.")
+    parser.add_argument("--cache_path", type=str, help="path of the schema terms cache, defaults to <data_dir>/schema_terms_cache.sqlite.")
+    parser.add_argument("--cache_size", type=int, default=2000000, help="maximum number of queries kept in the schema terms cache.")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="do not read or write the schema terms cache.")
+    parser.add_argument("--rebuild_cache", "--rebuild-cache", action="store_true", help="drop the schema terms cache before processing.")
+    parser.add_argument("--streaming", action="store_true", help="read, extract and write --chunk_size questions at a time with a shuffle on disk, so that the memory does not grow with the data sets.")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="number of questions processed at a time with --streaming.")
+    parser.add_argument("--incremental", action="store_true", help="reuse the schema terms of questions whose id and query are unchanged in the outputs of the previous run.")
+    parser.add_argument("--fast_path", type=str, default="", help="tasks (comma separated) whose triples are extracted with the tokenizer based fast path.")
+    parser.add_argument("--check_fast_path", action="store_true", help="compare the fast path with rdflib on <data_dir>/*/data_sets.json and exit.")
+    parser.add_argument("--profile", nargs="?", const="stages", choices=PROFILERS, help="write the time, rows/sec, peak memory and fallback/error counts of every stage to <data_dir>/profile.json, with cprofile or pyinstrument also dump a profile of the run.")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N", help="only process the questions whose id hashes to shard i of N (0 <= i < N), and write them unshuffled to <data_dir> for --merge.")
+    parser.add_argument("--merge", nargs="+", metavar="SHARD_DIR", help="combine the outputs of the --shard runs in the given directories into the outputs of a single-node run in <data_dir>.")
 
     args = parser.parse_args(arguments)
 
+    if args.refresh_answers and not args.kb_endpoint:
+        parser.error("--refresh_answers requires --kb_endpoint")
+    if args.shard and args.merge:
+        parser.error("--shard and --merge are separate runs")
+
+    if args.check_fast_path:
+        paths = sorted(glob.glob(os.path.join(args.data_dir, "*", "data_sets.json")))
+        return 1 if check_fast_path(paths, args.kb_lcquad2) else 0
+
     if not os.path.isdir(args.data_dir):
         os.mkdir(args.data_dir)
 
+    profiler.clear()
+    if args.profile:
+        profiler.enable(args.profile)
+
+    if args.merge:
+        try:
+            merge_shards(args)
+        except ValueError as e:
+            parser.error(str(e))
+        write_profile(args, arguments)
+        return 0
+
     tasks = get_tasks(args.tasks)
+    source = get_source(args.raw_dir)
+    fast_tasks = get_tasks(args.fast_path) if args.fast_path else []
+
+    cache = None
+    if not args.no_cache:
+        cache = SQLiteCache(args.cache_path or os.path.join(args.data_dir, "schema_terms_cache.sqlite"), args.cache_size)
+        if args.rebuild_cache:
+            cache.clear()
+    # kept apart from the schema terms, so that --rebuild_cache and --no_cache leave the responses alone
+    kb_cache = None
+    if args.refresh_answers and args.kb_cache_path:
+        kb_cache = SQLiteCache(args.kb_cache_path, args.cache_size)
+
+    previous = None
+    if args.incremental:
+        extension = ".parquet" if args.output_format == "parquet" else output_extension(args.output_format)
+        previous = load_previous_schema_terms(args.data_dir, [extension] + [e for e in (".json", ".jsonl", ".parquet") if e != extension])
+        print(f"loaded the schema terms of {len(previous)} questions of the previous run")
+    extraction_stats.clear()
+    sparql_util.fast_path_stats.clear()
 
-    questions = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
-    error_sets = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
     stats_file = open(os.path.join(args.data_dir, "stats.txt"), "w")
-    for task in tasks:
-        stats_file.write(f"==============={task}===============\n")
-        if task == "QALD":
-            data, errors = process_qald()
-        elif task == "LCQUAD":
-            data, errors = process_lcquad()
-        elif task == "LCQUAD2":
-            data, errors = process_lcquad2(args.kb_lcquad2)
-        else:
-            data = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
-            errors = pd.DataFrame(columns=["id", "question", "query", "schema_terms", "answers"])
-        stats_file.write(f"total: {len(data) + len(errors)}\ndata: {len(data)}\nerrors: {len(errors)}\n\n")
-        questions = pd.concat([questions, data])
-        error_sets = pd.concat([error_sets, errors])
+    checkpoint_path = os.path.join(args.data_dir, "answers_checkpoint.jsonl")
+    if args.refresh_answers:
+        # refresh_answers appends to it, resumed questions are listed again from the checkpoint
+        open(os.path.join(args.data_dir, ANSWER_LATENCIES), "w").close()
+    if args.shard:
+        preprocess_shard(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path)
+    elif args.streaming:
+        preprocess_streaming(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path)
+    else:
+        preprocess_in_memory(args, tasks, fast_tasks, source, cache, kb_cache, previous, stats_file, checkpoint_path)
+    if args.incremental:
+        print(f"reused the schema terms of {extraction_stats['reused']} questions, extracted {extraction_stats['extracted']}")
     stats_file.close()
+    if cache is not None:
+        cache.close()
+    if kb_cache is not None:
+        kb_cache.close()
 
-    if args.shuffle:
-        questions = questions.sample(frac=1, random_state=args.random_seed)
+    # the answers are in the outputs now, a later run starts from scratch
+    if args.refresh_answers and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
-    json.dump(json.loads(questions.to_json(orient="records")), open(os.path.join(args.data_dir, "data_sets.json"), "w"), indent=2)
-    json.dump(json.loads(error_sets.to_json(orient="records")), open(os.path.join(args.data_dir, "errors.json"), "w"), indent=2)
+    write_profile(args, arguments)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
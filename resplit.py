@@ -3,36 +3,46 @@ import argparse
 import sys
 import os
 import json
-from sklearn.model_selection import GroupShuffleSplit, train_test_split
-from functools import reduce
+import hashlib
+from collections import Counter
+from itertools import chain, islice, product
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pandas as pd
+from utils import columnar
+from utils.lazy import lazy_import
+from utils.json_writer import OUTPUT_FORMATS, output_extension, write_records
+from utils.profiling import PROFILERS, StageProfiler
+from utils.shared_records import SharedRecords
+from utils.term_index import SchemaTermIndex, LEVELS, ZERO_SHOT, COMPOSITIONAL, IID
+
+pd = lazy_import("pandas")
+model_selection = lazy_import("sklearn.model_selection")
+
+# number of duplicate GroupShuffleSplit candidates dropped, per kind of split
+candidate_stats = Counter()
+
+# stage report written with --profile
+profiler = StageProfiler()
 
 def get_single_terms(data):
-    single_terms = reduce(lambda x, y: x+y, data["schema_terms"].values.tolist())
+    single_terms = list(chain.from_iterable(data["schema_terms"].values.tolist()))
     return single_terms
 
 def get_schema_terms(data):
-    schema_terms = dict()
+    # the term combinations of a data set, as the group ids assigned by group_schema_terms
+    return set(data["schema_terms_group_idx"].tolist())
 
-    for idx, row in data.iterrows():
-        if tuple(sorted(row["schema_terms"])) not in schema_terms:
-            schema_terms[tuple(sorted(row["schema_terms"]))] = len(schema_terms)
-    return schema_terms
-
-def group_schema_terms(data):
-    terms2group = dict()
-    def func(x):
-        if tuple(sorted(x)) not in terms2group:
-            terms2group[tuple(sorted(x))] = len(terms2group)
-        return terms2group[tuple(sorted(x))]
-    data["schema_terms_group_idx"] = data["schema_terms"].map(lambda x: func(x))
+def group_schema_terms(data, index=None):
+    # questions with the same multi-set of schema terms share a group, numbered in order of first occurrence
+    if index is None:
+        index = SchemaTermIndex.from_frame(data)
+    data["schema_terms_group_idx"] = index.combination_ids
 
     return data
 
-def determine_level(schema_terms, single_terms_train, schema_terms_train):
-    unseen_terms = list(set(schema_terms).difference(set(single_terms_train)))
-    if tuple(sorted(schema_terms)) not in schema_terms_train:
+def determine_level(schema_terms, group_idx, single_terms_train, schema_terms_train):
+    unseen_terms = list(set(schema_terms).difference(single_terms_train))
+    if group_idx not in schema_terms_train:
         if len(unseen_terms) != 0:  # zero-shot
             level="zero-shot"
         else:
@@ -42,25 +52,75 @@ def determine_level(schema_terms, single_terms_train, schema_terms_train):
     return level
 
 
-def sample_zeroshot_questions(data, sampling_ratio, n_splits, random_seed):
-    group_ids = data["schema_terms_group_idx"].tolist()
-    groups = np.array(group_ids)
-    gss = GroupShuffleSplit(n_splits=n_splits, train_size=1-sampling_ratio, random_state=random_seed)
+def group_split_fingerprint(groups):
+    # whole groups are held out, so the set of held-out group ids identifies a candidate split
+    return hashlib.blake2b(np.unique(groups).astype(np.int64).tobytes(), digest_size=16).digest()
 
-    train_zeroshot_splits = []
+def sample_group_splits(groups, sampling_ratio, n_splits, random_seed, kind="group"):
+    # positions of the train and held-out questions of every distinct GroupShuffleSplit candidate
+    gss = model_selection.GroupShuffleSplit(n_splits=n_splits, train_size=1-sampling_ratio, random_state=random_seed)
 
     unique_group_splits = dict()
-    for train_idx, zeroshot_idx in gss.split(X=data, groups=groups):
-        if tuple(sorted(train_idx)) not in unique_group_splits:
-            unique_group_splits[tuple(sorted(train_idx))] = zeroshot_idx
+    for train_idx, heldout_idx in gss.split(X=groups, groups=groups):
+        fingerprint = group_split_fingerprint(groups[heldout_idx])
+        if fingerprint not in unique_group_splits:
+            unique_group_splits[fingerprint] = (np.sort(train_idx), heldout_idx)
+        else:
+            candidate_stats[kind] += 1
+
+    return list(unique_group_splits.values())
+
+def term_incidence(index, rows):
+    # the positions (into rows) of the questions of every term, in CSR layout: the questions of term t
+    # are term_rows[term_ptr[t]:term_ptr[t + 1]], a question listing a term twice is listed twice
+    lengths = index.row_lengths(rows)
+    term_ids = index.term_ids(rows)
+    owners = np.repeat(np.arange(len(rows), dtype=np.int64), lengths)
+    term_rows = owners[np.argsort(term_ids, kind="stable")]
+    term_ptr = np.zeros(index.num_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=index.num_terms), out=term_ptr[1:])
+    return term_ptr, term_rows
+
+def sample_term_splits(index, rows, sampling_ratio, n_splits, random_seed, kind="zero-shot"):
+    # positions (into rows) of the train and held-out questions of every distinct candidate, sampled
+    # term by term: a term is held out together with all the questions that use it, so that it is
+    # unseen in train and every held-out question is zero-shot. Terms are drawn in random order and
+    # kept as long as their questions fit in sampling_ratio of rows, so the zero-shot set reaches the
+    # requested size in one pass instead of being whittled down by zeroshot_filter. The held-out
+    # questions are whole groups, as questions with the same terms are held out with the same term.
+    term_ptr, term_rows = term_incidence(index, rows)
+    terms = np.flatnonzero(np.diff(term_ptr))
+    target = int(round(sampling_ratio * len(rows)))
+    groups = index.combination_ids[rows]
+    random_state = np.random.RandomState(random_seed)
+
+    unique_term_splits = dict()
+    for _ in range(n_splits):
+        heldout = np.zeros(len(rows), dtype=bool)
+        num_heldout = 0
+        for term in random_state.permutation(terms):
+            if num_heldout >= target:
+                break
+            term_questions = term_rows[term_ptr[term]:term_ptr[term + 1]]
+            new = np.unique(term_questions[~heldout[term_questions]])
+            if num_heldout + len(new) <= target:
+                heldout[new] = True
+                num_heldout += len(new)
+        train_idx, heldout_idx = np.flatnonzero(~heldout), np.flatnonzero(heldout)
+        fingerprint = group_split_fingerprint(groups[heldout_idx])
+        if fingerprint not in unique_term_splits:
+            unique_term_splits[fingerprint] = (train_idx, heldout_idx)
+        else:
+            candidate_stats[kind] += 1
 
-    for train_idx, zeroshot_idx in unique_group_splits.items():
-        train_idx = list(train_idx)
+    return list(unique_term_splits.values())
 
-        train_set = data.iloc[train_idx]
-        zeroshot_set = data.iloc[zeroshot_idx]
+def sample_zeroshot_questions(data, sampling_ratio, n_splits, random_seed):
+    groups = np.array(data["schema_terms_group_idx"].tolist())
 
-        train_zeroshot_splits.append((train_set, zeroshot_set))
+    train_zeroshot_splits = []
+    for train_idx, zeroshot_idx in sample_group_splits(groups, sampling_ratio, n_splits, random_seed, "zero-shot"):
+        train_zeroshot_splits.append((data.iloc[train_idx], data.iloc[zeroshot_idx]))
 
     return train_zeroshot_splits
 
@@ -69,33 +129,24 @@ def sample_compositional_questions(data, sampling_ratio, n_splits, random_seed):
     if sampling_ratio == 0.0:
         return []
 
-    group_ids = data["schema_terms_group_idx"].tolist()
-    groups = np.array(group_ids)
-    gss = GroupShuffleSplit(n_splits=n_splits, train_size=1-sampling_ratio, random_state=random_seed)
+    groups = np.array(data["schema_terms_group_idx"].tolist())
 
     train_compos_splits = []
-
-    unique_group_splits = dict()
-    for train_idx, compo_idx in gss.split(X=data, groups=groups):
-        if tuple(sorted(train_idx)) not in unique_group_splits:
-            unique_group_splits[tuple(sorted(train_idx))] = compo_idx
-
-    for train_idx, compo_idx in unique_group_splits.items():
-        train_idx = list(train_idx)
-
-        train_set = data.iloc[train_idx]
-        compo_set = data.iloc[compo_idx]
-
-        train_compos_splits.append((train_set, compo_set))
+    for train_idx, compo_idx in sample_group_splits(groups, sampling_ratio, n_splits, random_seed, "compositional"):
+        train_compos_splits.append((data.iloc[train_idx], data.iloc[compo_idx]))
 
     return train_compos_splits
 
-def data_filter(data_src, train_set):
+def data_filter(data_src, train_set, index=None, vocabulary=None):
 
-    single_schema_terms_train = get_single_terms(train_set)
-    schema_terms_train = get_schema_terms(train_set)
+    if index is not None:
+        data_src["level"] = index.classify_frame(data_src, train_set, vocabulary)
+    else:
+        single_schema_terms_train = set(get_single_terms(train_set))
+        schema_terms_train = get_schema_terms(train_set)
 
-    data_src["level"] = data_src["schema_terms"].map(lambda x: determine_level(x, single_schema_terms_train, schema_terms_train))
+        data_src["level"] = [determine_level(terms, group_idx, single_schema_terms_train, schema_terms_train)
+                             for terms, group_idx in zip(data_src["schema_terms"], data_src["schema_terms_group_idx"])]
     zero_set = data_src[data_src['level']=="zero-shot"]
     compo_set = data_src[data_src['level']=="compositional"]
     iid_set = data_src[data_src['level']=="i.i.d."]
@@ -103,18 +154,18 @@ def data_filter(data_src, train_set):
     return zero_set, compo_set, iid_set
 
 
-def zeroshot_filter(zeroshot_set, train_set):
+def zeroshot_filter(zeroshot_set, train_set, index=None, vocabulary=None):
 
-    zeroshot_set, compositional_set, iid_set = data_filter(zeroshot_set, train_set)
+    zeroshot_set, compositional_set, iid_set = data_filter(zeroshot_set, train_set, index, vocabulary)
 
     non_zeroshot_set = pd.concat([compositional_set, iid_set])
 
     return zeroshot_set, non_zeroshot_set
 
 
-def compositional_filter(compositional_set, train_set):
+def compositional_filter(compositional_set, train_set, index=None, vocabulary=None):
 
-    zeroshot_set, compositional_set, iid_set = data_filter(compositional_set, train_set)
+    zeroshot_set, compositional_set, iid_set = data_filter(compositional_set, train_set, index, vocabulary)
 
     non_compositional_set = pd.concat([zeroshot_set, iid_set])
 
@@ -122,10 +173,398 @@ def compositional_filter(compositional_set, train_set):
 
 
 def sample_iid_questions(data, sampling_ratio, random_seed):
-    train_set, iid_set = train_test_split(data, train_size=1-sampling_ratio, random_state=random_seed)
+    train_set, iid_set = model_selection.train_test_split(data, train_size=1-sampling_ratio, random_state=random_seed)
     return train_set, iid_set
 
 
+def split_by_level(rows, levels):
+    return rows[levels == ZERO_SHOT], rows[levels == COMPOSITIONAL], rows[levels == IID]
+
+
+# The candidate splits as arrays of row positions into the indexed data set, following the same
+# sampling and filtering steps as the frame-based functions above. Every candidate derives from one
+# split of the level sampled first (zero-shot, else compositional, else i.i.d.), which expand_candidate
+# takes further, so that the candidates can be generated per first split in separate processes.
+def first_splits(index, groups, args):
+    # (train, held out) positions of the candidates of the level sampled first
+    data_sets = np.arange(len(index), dtype=np.int64)
+    if args.sampling_ratio_zero > 0.0:
+        if args.zeroshot_sampler == "cooccurrence":
+            return sample_term_splits(index, data_sets, args.sampling_ratio_zero, args.n_splits_zero, args.random_seed)
+        return sample_group_splits(groups, args.sampling_ratio_zero, args.n_splits_zero, args.random_seed, "zero-shot")
+    if args.sampling_ratio_compo > 0.0:
+        return sample_group_splits(groups, args.sampling_ratio_compo, args.n_splits_compo, args.random_seed, "compositional")
+    if args.sampling_ratio_iid > 0.0:
+        return [sample_iid_questions(data_sets, args.sampling_ratio_iid, args.random_seed)]
+    return []
+
+
+# Yields (zero, compo, iid, train, vocabulary) per candidate that derives from the first split
+# (train_idx, heldout_idx), where vocabulary is the term vocabulary of train or None.
+def expand_candidate(index, groups, args, first_split):
+    empty = np.empty(0, dtype=np.int64)
+    data_sets = np.arange(len(index), dtype=np.int64)
+
+    def zeroshot_candidate(rows, train_idx, zeroshot_idx):
+        train_set_1 = rows[train_idx]
+        vocabulary = index.vocabulary(train_set_1)
+        zeroshot_set, compositional_set, iid_set = split_by_level(rows[zeroshot_idx], index.classify(rows[zeroshot_idx], vocabulary))
+        non_zeroshot_set = np.concatenate([compositional_set, iid_set])
+        vocabulary.add(non_zeroshot_set)
+        return zeroshot_set, np.concatenate([train_set_1, non_zeroshot_set]), vocabulary
+
+    def compositional_candidate(rows, train_idx, compo_idx, vocabulary=None):
+        train_set_2 = rows[train_idx]
+        if vocabulary is None:
+            vocabulary_2 = index.vocabulary(train_set_2)
+        else:
+            # train_set_2 is rows without the sampled compositional questions
+            vocabulary_2 = vocabulary.copy().remove(rows[compo_idx])
+        zeroshot_set, compositional_set, iid_set = split_by_level(rows[compo_idx], index.classify(rows[compo_idx], vocabulary_2))
+        non_compositional_set = np.concatenate([zeroshot_set, iid_set])
+        vocabulary_2.add(non_compositional_set)
+        return compositional_set, np.concatenate([train_set_2, non_compositional_set]), vocabulary_2
+
+    def compositional_candidates(rows, vocabulary):
+        if args.sampling_ratio_compo == 0.0:
+            return
+        for train_idx, compo_idx in sample_group_splits(groups[rows], args.sampling_ratio_compo, args.n_splits_compo, args.random_seed, "compositional"):
+            yield compositional_candidate(rows, train_idx, compo_idx, vocabulary)
+
+    def iid_split(rows, vocabulary):
+        train_set, iid_set = sample_iid_questions(rows, args.sampling_ratio_iid, args.random_seed)
+        return iid_set, train_set, vocabulary.remove(iid_set)
+
+    if args.sampling_ratio_iid == 0.0 and args.sampling_ratio_compo == 0.0 and args.sampling_ratio_zero > 0.0:
+        zeroshot_set, train_set, vocabulary = zeroshot_candidate(data_sets, *first_split)
+        yield zeroshot_set, empty, empty, train_set, vocabulary
+    elif args.sampling_ratio_iid == 0.0 and args.sampling_ratio_compo > 0.0 and args.sampling_ratio_zero == 0.0:
+        compositional_set, train_set, vocabulary = compositional_candidate(data_sets, *first_split)
+        yield empty, compositional_set, empty, train_set, vocabulary
+    elif args.sampling_ratio_iid > 0.0 and args.sampling_ratio_compo == 0.0 and args.sampling_ratio_zero == 0.0:
+        train_set, iid_set = first_split
+        yield empty, empty, iid_set, train_set, None
+    elif args.sampling_ratio_zero > 0.0:
+        zeroshot_set, intermediate_train_set_1, vocabulary_1 = zeroshot_candidate(data_sets, *first_split)
+        if args.sampling_ratio_compo > 0.0:
+            for compositional_set, intermediate_train_set_2, vocabulary in compositional_candidates(intermediate_train_set_1, vocabulary_1):
+                if args.sampling_ratio_iid > 0.0:
+                    iid_set, train_set, vocabulary = iid_split(intermediate_train_set_2, vocabulary)
+                    yield zeroshot_set, compositional_set, iid_set, train_set, vocabulary
+                else:
+                    yield zeroshot_set, compositional_set, empty, intermediate_train_set_2, vocabulary
+        else:
+            iid_set, train_set, vocabulary = iid_split(intermediate_train_set_1, vocabulary_1)
+            yield zeroshot_set, empty, iid_set, train_set, vocabulary
+    else:
+        compositional_set, intermediate_train_set_2, vocabulary = compositional_candidate(data_sets, *first_split)
+        iid_set, train_set, vocabulary = iid_split(intermediate_train_set_2, vocabulary)
+        yield empty, compositional_set, iid_set, train_set, vocabulary
+
+
+def generate_candidates(index, groups, args):
+    for first_split in first_splits(index, groups, args):
+        yield from expand_candidate(index, groups, args, first_split)
+
+
+def assemble_split(index, zero, compo, iid, train, vocabulary=None):
+    # re-levels the held-out questions against the final train set. Returns the train rows, the
+    # test rows (zero-shot, compositional, i.i.d. in that order) and the level of every test row.
+    if vocabulary is None:
+        vocabulary = index.vocabulary(train)
+
+    empty = np.empty(0, dtype=np.int64)
+    level_sets = [[empty], [empty], [empty]]
+    for rows in (zero, compo, iid):
+        if len(rows):
+            for level, level_rows in enumerate(split_by_level(rows, index.classify(rows, vocabulary))):
+                level_sets[level].append(level_rows)
+    zero_set_tmp, compo_set_tmp, iid_set_tmp = [np.concatenate(rows) for rows in level_sets]
+
+    # held-out questions of a level that was not sampled are merged back into the train set
+    test_sets = {ZERO_SHOT: zero_set_tmp, COMPOSITIONAL: compo_set_tmp, IID: iid_set_tmp}
+    for level, sampled in ((ZERO_SHOT, zero), (IID, iid), (COMPOSITIONAL, compo)):
+        if not len(sampled):
+            train = np.concatenate([train, test_sets[level]])
+            test_sets[level] = test_sets[level][:0]
+
+    levels = (ZERO_SHOT, COMPOSITIONAL, IID)
+    test = np.concatenate([test_sets[level] for level in levels])
+    test_levels = np.concatenate([np.full(len(test_sets[level]), level, dtype=np.int64) for level in levels])
+    return train, test, test_levels
+
+
+# bins of the train frequency of the terms of a level in stats.txt, with their labels
+FREQUENCY_BINS = [0, 1, 2, 5, 10, 100, np.inf]
+FREQUENCY_LABELS = ["0", "1", "2-4", "5-9", "10-99", "100+"]
+
+
+def term_statistics(index, train, test, test_levels):
+    # term coverage of the held-out (valid and test) questions and of every level by the train set, the mean number of unseen terms
+    # per question and the histogram of the train frequency of the distinct terms of every level
+    train_counts = index.term_counts(train)
+    unseen_terms = (train_counts == 0).astype(np.int64)
+    test_terms = np.flatnonzero(index.term_counts(test))
+    seen = np.count_nonzero(train_counts[test_terms])
+    lines = [f"terms: train {np.count_nonzero(train_counts)}, held out (valid + test) {len(test_terms)}, "
+             f"held-out terms seen in train {seen} ({seen / max(len(test_terms), 1) * 100:.1f} %)"]
+    for level, name in enumerate(("zero", "compo", "iid")):
+        rows = test[test_levels == level]
+        if not len(rows):
+            continue
+        terms = np.flatnonzero(index.term_counts(rows))
+        frequencies = train_counts[terms]
+        histogram, _ = np.histogram(frequencies, bins=FREQUENCY_BINS)
+        unseen = index.unseen_counts(rows, unseen_terms).mean()
+        lines.append(f"{name} terms: {len(terms)} (seen in train {np.count_nonzero(frequencies) / max(len(terms), 1) * 100:.1f} %), "
+                     f"unseen terms per question: {unseen:.2f}, train frequency of the terms: "
+                     + " | ".join(f"{label}: {count}" for label, count in zip(FREQUENCY_LABELS, histogram)))
+    return "\n".join(lines)
+
+
+_worker_records = None
+_worker_index = None
+
+
+def _init_worker(name, index, groups):
+    global _worker_records, _worker_index
+    _worker_records = SharedRecords.attach(name)
+    _worker_index = (index, groups)
+
+
+def _assemble_in_worker(task):
+    # the assembled splits of the candidates of one first split, with the duplicates dropped meanwhile
+    args, first_split = task
+    index, groups = _worker_index
+    candidate_stats.clear()
+    splits = [assemble_split(index, *candidate) for candidate in expand_candidate(index, groups, args, first_split)]
+    return splits, dict(candidate_stats)
+
+
+def _write_split_in_worker(task):
+    return write_split(_worker_records, *task)
+
+
+def write_split(records, split_dir, split_idx, dataset_id, train, test, test_levels, validation_size, random_seed, num_samples, level_sizes,
+                output_format="json", term_stats=None):
+    if not os.path.isdir(split_dir):
+        os.makedirs(split_dir)
+
+    def write_questions(name, rows, levels=None):
+        questions = records.records(rows)
+        if levels is not None:
+            questions = (dict(record, level=level) for record, level in zip(questions, levels))
+        path = os.path.join(split_dir, f"{dataset_id}-{name}{output_extension(output_format)}")
+        write_records(path, questions, {"id": f"{dataset_id}-{name}"}, output_format)
+
+    test_levels = LEVELS[test_levels]
+    if validation_size > 0.0:
+        validation, test, validation_levels, test_levels = model_selection.train_test_split(test, test_levels, train_size=validation_size, stratify=test_levels, random_state=random_seed)
+        write_questions("valid", validation, validation_levels)
+
+    write_questions("train", train)
+    write_questions("test", test, test_levels)
+
+    zero, compo, iid = level_sizes
+    stats_file = open(os.path.join(split_dir, "stats.txt"), "w")
+    stats_file.write("==============Split %d==============\n" % split_idx)
+    if validation_size > 0.0:
+        stats_file.write(
+            f"total: {num_samples}\ntrain: {len(train)} ({len(train)/num_samples*100} %%)\nvalid: {len(validation)}({len(validation)/num_samples*100} %%)\ntest: {len(test)}({len(test)/num_samples*100} %%)\nzero: {zero} ({zero/num_samples*100} %%)\ncompo: {compo} ({compo/num_samples*100} %%)\niid: {iid} ({iid/num_samples*100} %%)"
+        )
+    else:
+        stats_file.write(
+            f"total: {num_samples}\ntrain: {len(train)} ({len(train) / num_samples * 100} %%)\ntest: {len(test)}({len(test) / num_samples * 100} %%)\nzero: {zero} ({zero / num_samples * 100} %%)\ncompo: {compo} ({compo / num_samples * 100} %%)\niid: {iid} ({iid / num_samples * 100} %%)"
+        )
+    if term_stats:
+        stats_file.write("\n" + term_stats)
+    stats_file.write("\n\n")
+    stats_file.close()
+
+
+class DataSet:
+    # a data set loaded and indexed once: the term index, the group of every question and the records
+    # the split files are written from. The questions are only addressed by position.
+
+    def __init__(self, index, groups, records):
+        self.index = index
+        self.groups = groups
+        self.records = records
+
+    def __len__(self):
+        return len(self.index)
+
+
+def load_data_set(input_path):
+    records = None
+    with profiler.stage("load") as stage:
+        if columnar.is_parquet(input_path):
+            # only the ids and schema terms are decoded, the questions are copied as JSON into the records
+            table = columnar.read_table(input_path)
+            data_sets = columnar.read_frame(table)
+            records = SharedRecords.from_lines(columnar.record_lines(table))
+        else:
+            data_sets = pd.read_json(input_path, orient="records", lines=input_path.endswith(".jsonl"))
+        stage.rows += len(data_sets)
+
+    with profiler.stage("index", rows=len(data_sets)):
+        index = SchemaTermIndex.from_frame(data_sets)
+        data_sets = group_schema_terms(data_sets, index)
+
+    if records is None:
+        with profiler.stage("records", rows=len(data_sets)):
+            records = SharedRecords.from_frame(data_sets[["id", "question", "query", "answers", "schema_terms"]])
+    # from here on the questions are only addressed by position, their content is in the records
+    return DataSet(index, data_sets["schema_terms_group_idx"].to_numpy(), records)
+
+
+def write_splits(data_set, args):
+    # generates the splits of the sampling parameters in args and writes them to args.output_dir
+    index, groups, records, num_samples = data_set.index, data_set.groups, data_set.records, len(data_set)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    candidate_stats.clear()
+
+    def split_tasks(splits):
+        # only the first two splits are needed to name the split directories
+        splits = iter(splits)
+        first_two = list(islice(splits, 2))
+        for idx, (train, test, test_levels) in enumerate(chain(first_two, splits), 1):
+            split_dir_name = "new_split_"+str(idx) if len(first_two) > 1 else "new_split"
+            level_sizes = tuple(int(n) for n in np.bincount(test_levels, minlength=len(LEVELS)))
+            with profiler.stage("stats", rows=num_samples):
+                term_stats = term_statistics(index, train, test, test_levels)
+            yield (os.path.join(args.output_dir, split_dir_name), idx, args.dataset_id, train, test, test_levels,
+                   args.validation_size, args.random_seed, num_samples, level_sizes, args.output_format, term_stats)
+
+    with profiler.stage("assemble"):
+        first = first_splits(index, groups, args)
+    if args.workers <= 1 or len(first) <= 1:
+        # splits are assembled lazily, one at a time
+        candidates = chain.from_iterable(expand_candidate(index, groups, args, first_split) for first_split in first)
+        splits = profiler.iterate("assemble", (assemble_split(index, *candidate) for candidate in candidates))
+        for task in split_tasks(splits):
+            with profiler.stage("write", rows=num_samples):
+                write_split(records, *task)
+    else:
+        # every first split is expanded and assembled in a worker, the results are taken in the order of the first
+        # splits, so the splits and their numbering are those of a single-process run. The workers then write the
+        # splits, reading the questions from shared memory, only the row positions of a split are sent to them.
+        # The assemble and write stages are the time spent waiting for them.
+        with records.share() as shared_records, \
+                ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                    initargs=(shared_records.name, index, groups)) as executor:
+            with profiler.stage("assemble") as stage:
+                splits = []
+                for assembled, stats in executor.map(_assemble_in_worker, [(args, first_split) for first_split in first]):
+                    splits.extend(assembled)
+                    candidate_stats.update(stats)
+                stage.rows += len(splits)
+            with profiler.stage("write") as stage:
+                for _ in executor.map(_write_split_in_worker, split_tasks(splits)):
+                    stage.rows += num_samples
+
+    for kind, sampling_ratio in (("zero-shot", args.sampling_ratio_zero), ("compositional", args.sampling_ratio_compo)):
+        if sampling_ratio > 0.0:
+            print(f"dropped {candidate_stats[kind]} duplicate {kind} candidate splits")
+    profiler.get("assemble").counts.update(candidate_stats)
+
+
+# parameters that can be swept with --sweep, with their type
+SWEEP_PARAMETERS = {
+    "sampling_ratio_zero": float,
+    "sampling_ratio_compo": float,
+    "sampling_ratio_iid": float,
+    "random_seed": int,
+    "n_splits_zero": int,
+    "n_splits_compo": int,
+}
+
+
+def sweep_parameter(spec):
+    # parses NAME=VALUE,VALUE,... of --sweep
+    name, _, values = spec.partition("=")
+    if name not in SWEEP_PARAMETERS or not values:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE,... with NAME one of {', '.join(SWEEP_PARAMETERS)}, got {spec!r}")
+    try:
+        return name, [SWEEP_PARAMETERS[name](value) for value in values.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid {SWEEP_PARAMETERS[name].__name__} value in {spec!r}")
+
+
+def sweep_configurations(args, grid):
+    # the arguments of every combination of the swept values, the other parameters are the ones of args
+    names = [name for name, _ in grid]
+    return [argparse.Namespace(**dict(vars(args), **dict(zip(names, values))))
+            for values in product(*[values for _, values in grid])]
+
+
+def split_sizes(index, groups, args):
+    # train and level sizes of the splits args would produce, without writing them, and the number of
+    # duplicate candidates dropped
+    candidate_stats.clear()
+    sizes = []
+    for candidate in generate_candidates(index, groups, args):
+        train, test, test_levels = assemble_split(index, *candidate)
+        zero, compo, iid = (int(n) for n in np.bincount(test_levels, minlength=len(LEVELS)))
+        sizes.append({"train": len(train), "zero": zero, "compo": compo, "iid": iid})
+    return sizes, dict(candidate_stats)
+
+
+_worker_data_set = None
+
+
+def _init_sweep_worker(index, groups):
+    global _worker_data_set
+    _worker_data_set = (index, groups)
+
+
+def _split_sizes_in_worker(args):
+    return split_sizes(*_worker_data_set, args)
+
+
+def sweep(data_set, configurations, workers=1):
+    # the split sizes of every configuration (argparse.Namespace of the resplit.py arguments), evaluated
+    # on the data set as loaded and indexed once, in a pool of processes if workers > 1
+    with profiler.stage("sweep", rows=len(data_set) * len(configurations)):
+        if workers <= 1 or len(configurations) <= 1:
+            return [split_sizes(data_set.index, data_set.groups, args) for args in configurations]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, initargs=(data_set.index, data_set.groups)) as executor:
+            return list(executor.map(_split_sizes_in_worker, configurations))
+
+
+def run_sweep(data_set, args):
+    # prints and writes the summary of the sweep, then writes the splits of the selected configurations
+    # a parameter given twice takes its last values
+    grid = list(dict(args.sweep).items())
+    configurations = sweep_configurations(args, grid)
+    results = sweep(data_set, configurations, args.workers)
+
+    names = [name for name, _ in grid]
+    summary = []
+    print("\t".join(["config"] + names + ["split", "train", "zero", "compo", "iid", "duplicates"]))
+    for number, (config, (sizes, duplicates)) in enumerate(zip(configurations, results), 1):
+        for split_idx, split in enumerate(sizes, 1):
+            summary.append(dict({"config": number, "split": split_idx}, **{name: getattr(config, name) for name in names}, **split,
+                                duplicates=sum(duplicates.values())))
+            print("\t".join(str(value) for value in [number] + [getattr(config, name) for name in names]
+                            + [split_idx, split["train"], split["zero"], split["compo"], split["iid"], sum(duplicates.values())]))
+
+    summary_path = os.path.join(args.output_dir, "sweep.json")
+    with open(summary_path, "w") as f:
+        json.dump({"num_samples": len(data_set), "parameters": names, "splits": summary}, f, indent=2)
+    print(f"wrote the summary of {len(configurations)} configurations to {summary_path}")
+
+    for number in args.sweep_select or []:
+        if not 1 <= number <= len(configurations):
+            print(f"there is no configuration {number}")
+            continue
+        config = argparse.Namespace(**dict(vars(configurations[number - 1]), output_dir=os.path.join(args.output_dir, f"sweep_{number}")))
+        write_splits(data_set, config)
+        print(f"wrote the splits of configuration {number} to {config.output_dir}")
+
+
 def main(arguments):
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset_id", type=str, help="the unique identifier of the dataset newly generated.")
@@ -137,174 +576,34 @@ def main(arguments):
     parser.add_argument("--sampling_ratio_zero", default=.4, type=float, help="the ratio for sampling zeroshot questions from the data set.")
     parser.add_argument("--sampling_ratio_compo", default=.1, type=float, help="the ratio for sampling compositional questions from the data set.")
     parser.add_argument("--sampling_ratio_iid", default=.1, type=float, help="the ratio for sampling iid questions from the data set.")
+    parser.add_argument("--zeroshot_sampler", default="groups", choices=["groups", "cooccurrence"], help="how zero-shot candidates are drawn: random groups of questions (GroupShuffleSplit) or whole terms with all their questions, which reaches --sampling_ratio_zero in one pass.")
     parser.add_argument("--validation_size", default=.33, type=float, help="the size of validation set splitted from the test size.")
+    parser.add_argument("--output_format", default="json", choices=OUTPUT_FORMATS, help="json (indented), compact json or jsonl (one question per line).")
+    parser.add_argument("-w", "--workers", default=1, type=int, help="number of processes used to generate and write the splits, or to evaluate the configurations of a sweep.")
+    parser.add_argument("--profile", nargs="?", const="stages", choices=PROFILERS, help="write the time, rows/sec and peak memory of every stage to <output_dir>/profile.json, with cprofile or pyinstrument also dump a profile of the run.")
+    parser.add_argument("--sweep", nargs="+", type=sweep_parameter, metavar="NAME=VALUE,...", help=f"evaluate every combination of the given values of {', '.join(SWEEP_PARAMETERS)} on the data set loaded once, and write the split sizes to <output_dir>/sweep.json instead of the splits.")
+    parser.add_argument("--sweep_select", type=lambda value: [int(number) for number in value.split(",")], help="comma separated numbers of the sweep configurations whose splits are written, to <output_dir>/sweep_<number>.")
 
     args = parser.parse_args(arguments)
 
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
 
-    data_sets = pd.read_json(args.input_path, orient="records")
-
-    data_sets = group_schema_terms(data_sets)
-    num_samples = len(data_sets)
+    profiler.clear()
+    if args.profile:
+        profiler.enable(args.profile)
 
-    empty_data = pd.DataFrame(columns=data_sets.columns)
-    candidate_zero_compo_iid_train_splits = []
-
-    if args.sampling_ratio_iid == 0.0 and args.sampling_ratio_compo == 0.0 and args.sampling_ratio_zero > 0.0:
-        candidate_train_zeroshot_splits = sample_zeroshot_questions(data_sets, args.sampling_ratio_zero,
-                                                                    args.n_splits_zero,
-                                                                    args.random_seed)
-        for train_set_1, zeroshot_set_1 in candidate_train_zeroshot_splits:
-            zeroshot_set, non_zeroshot_set = zeroshot_filter(zeroshot_set_1, train_set_1)
-            train_set = pd.concat([train_set_1, non_zeroshot_set])
-            candidate_zero_compo_iid_train_splits.append((zeroshot_set, empty_data, empty_data, train_set))
-    elif args.sampling_ratio_iid == 0.0 and args.sampling_ratio_compo > 0.0 and args.sampling_ratio_zero == 0.0:
-        candidate_train_compo_splits = sample_compositional_questions(data_sets,
-                                                                      args.sampling_ratio_compo,
-                                                                      args.n_splits_compo, args.random_seed)
-        for train_set_2, compositional_set_1 in candidate_train_compo_splits:
-            compositional_set, non_compositional_set = compositional_filter(compositional_set_1, train_set_2)
-            train_set = pd.concat([train_set_2, non_compositional_set])
-            candidate_zero_compo_iid_train_splits.append((empty_data, compositional_set, empty_data, train_set))
-    elif args.sampling_ratio_iid > 0.0 and args.sampling_ratio_compo == 0.0 and args.sampling_ratio_zero == 0.0:
-        train_set, iid_set = sample_iid_questions(data_sets, args.sampling_ratio_iid, args.random_seed)
-        candidate_zero_compo_iid_train_splits.append((empty_data, empty_data, iid_set, train_set))
+    data_set = load_data_set(args.input_path)
+    if args.sweep:
+        run_sweep(data_set, args)
     else:
-        if args.sampling_ratio_zero > 0.0:
-            candidate_train_zeroshot_splits = sample_zeroshot_questions(data_sets, args.sampling_ratio_zero, args.n_splits_zero,
-                                                                        args.random_seed)
-
-            for train_set_1, zeroshot_set_1 in candidate_train_zeroshot_splits:
-
-                zeroshot_set, non_zeroshot_set = zeroshot_filter(zeroshot_set_1, train_set_1)
-                intermediate_train_set_1 = pd.concat([train_set_1, non_zeroshot_set])
-
-                if args.sampling_ratio_compo > 0.0:
-                    candidate_train_compo_splits = sample_compositional_questions(intermediate_train_set_1, args.sampling_ratio_compo,
-                                                                                  args.n_splits_compo, args.random_seed)
-                    for train_set_2, compositional_set_1 in candidate_train_compo_splits:
-                        compositional_set, non_compositional_set = compositional_filter(compositional_set_1, train_set_2)
-                        intermediate_train_set_2 = pd.concat([train_set_2, non_compositional_set])
-
-                        if args.sampling_ratio_iid > 0.0:
-                            train_set, iid_set = sample_iid_questions(intermediate_train_set_2, args.sampling_ratio_iid, args.random_seed)
-                            candidate_zero_compo_iid_train_splits.append((zeroshot_set, compositional_set, iid_set, train_set))
-                        else:
-                            candidate_zero_compo_iid_train_splits.append(
-                                (zeroshot_set, compositional_set, empty_data, intermediate_train_set_2))
-                else:
-                    train_set, iid_set = sample_iid_questions(intermediate_train_set_1, args.sampling_ratio_iid,
-                                                              args.random_seed)
-                    candidate_zero_compo_iid_train_splits.append((zeroshot_set, empty_data, iid_set, train_set))
-        else:
-            candidate_train_compo_splits = sample_compositional_questions(data_sets,
-                                                                          args.sampling_ratio_compo,
-                                                                          args.n_splits_compo, args.random_seed)
-            for train_set_2, compositional_set_1 in candidate_train_compo_splits:
-                compositional_set, non_compositional_set = compositional_filter(compositional_set_1, train_set_2)
-                intermediate_train_set_2 = pd.concat([train_set_2, non_compositional_set])
-
-                train_set, iid_set = sample_iid_questions(intermediate_train_set_2, args.sampling_ratio_iid,
-                                                          args.random_seed)
-                candidate_zero_compo_iid_train_splits.append((empty_data, compositional_set, iid_set, train_set))
-
-    train_zero_compo_iid_splits = []
-
-    for zero, compo, iid, train in candidate_zero_compo_iid_train_splits:
-
-        zero_set_tmp = pd.DataFrame(columns=train.columns)
-        compo_set_tmp = pd.DataFrame(columns=train.columns)
-        iid_set_tmp = pd.DataFrame(columns=train.columns)
-
-        if not zero.empty:
-            zero_set_1, compo_set_1, iid_set_1 = data_filter(zero, train)
-            zero_set_tmp = pd.concat([zero_set_tmp, zero_set_1])
-            compo_set_tmp = pd.concat([compo_set_tmp, compo_set_1])
-            iid_set_tmp = pd.concat([iid_set_tmp, iid_set_1])
-
-        if not compo.empty:
-            zero_set_2, compo_set_2, iid_set_2 = data_filter(compo, train)
-            zero_set_tmp = pd.concat([zero_set_tmp, zero_set_2])
-            compo_set_tmp = pd.concat([compo_set_tmp, compo_set_2])
-            iid_set_tmp = pd.concat([iid_set_tmp, iid_set_2])
-
-        if not iid.empty:
-            zero_set_3, compo_set_3, iid_set_3 = data_filter(iid, train)
-            zero_set_tmp = pd.concat([zero_set_tmp, zero_set_3])
-            compo_set_tmp = pd.concat([compo_set_tmp, compo_set_3])
-            iid_set_tmp = pd.concat([iid_set_tmp, iid_set_3])
-
-        if zero.empty:
-            train = pd.concat([train, zero_set_tmp])
-            zero_set = empty_data
-        else:
-            zero_set = zero_set_tmp
-
-        if iid.empty:
-            train = pd.concat([train, iid_set_tmp])
-            iid_set = empty_data
-        else:
-            iid_set = iid_set_tmp
+        write_splits(data_set, args)
 
-        if compo.empty:
-            train = pd.concat([train, compo_set_tmp])
-            compo_set = empty_data
-        else:
-            compo_set = compo_set_tmp
-
-        train_zero_compo_iid_splits.append((train, zero_set, compo_set, iid_set))
-
-    for idx, splits in enumerate(train_zero_compo_iid_splits, 1):
-
-        split_dir_name = "new_split_"+str(idx) if len(train_zero_compo_iid_splits) > 1 else "new_split"
-        split_dir = os.path.join(args.output_dir, split_dir_name)
-        if not os.path.isdir(split_dir):
-            os.makedirs(split_dir)
-
-        train, zero, compo, iid = splits
-
-        train = train[["id", "question", "query", "answers", "schema_terms"]]
-        test = pd.concat([zero, compo, iid])[["id", "question", "query", "answers", "schema_terms", "level"]]
-
-        if args.validation_size > 0.0:
-            validation, test, _, _ = train_test_split(test, test["level"], train_size=args.validation_size, stratify=test["level"], random_state=args.random_seed)
-            json_rslt_valid = {
-                "dataset": {
-                    "id": f"{args.dataset_id}-valid"
-                },
-                "questions": json.loads(validation.to_json(orient="records"))
-            }
-            json.dump(json_rslt_valid, open(os.path.join(split_dir, f"{args.dataset_id}-valid.json"), "w"), indent=2)
-
-        json_rslt_train = {
-            "dataset": {
-                "id": f"{args.dataset_id}-train"
-            },
-            "questions": json.loads(train.to_json(orient="records"))
-        }
-        json.dump(json_rslt_train, open(os.path.join(split_dir, f"{args.dataset_id}-train.json"), "w"), indent=2)
-        json_rslt_test = {
-            "dataset": {
-                "id": f"{args.dataset_id}-test"
-            },
-            "questions": json.loads(test.to_json(orient="records"))
-        }
-        json.dump(json_rslt_test, open(os.path.join(split_dir, f"{args.dataset_id}-test.json"), "w"), indent=2)
-
-        stats_file = open(os.path.join(split_dir, "stats.txt"), "w")
-        stats_file.write("==============Split %d==============\n" % idx)
-        if args.validation_size > 0.0:
-            stats_file.write(
-                f"total: {num_samples}\ntrain: {len(train)} ({len(train)/num_samples*100} %%)\nvalid: {len(validation)}({len(validation)/num_samples*100} %%)\ntest: {len(test)}({len(test)/num_samples*100} %%)\nzero: {len(zero)} ({len(zero)/num_samples*100} %%)\ncompo: {len(compo)} ({len(compo)/num_samples*100} %%)\niid: {len(iid)} ({len(iid)/num_samples*100} %%)"
-            )
-        else:
-            stats_file.write(
-                f"total: {num_samples}\ntrain: {len(train)} ({len(train) / num_samples * 100} %%)\ntest: {len(test)}({len(test) / num_samples * 100} %%)\nzero: {len(zero)} ({len(zero) / num_samples * 100} %%)\ncompo: {len(compo)} ({len(compo) / num_samples * 100} %%)\niid: {len(iid)} ({len(iid) / num_samples * 100} %%)"
-            )
-        stats_file.write("\n\n")
-        stats_file.close()
+    if args.profile:
+        report_path = os.path.join(args.output_dir, "profile.json")
+        dump_path = profiler.dump(os.path.join(args.output_dir, "profile"))
+        profiler.write(report_path, command="resplit", arguments=arguments, profile_dump=dump_path)
+        print(f"wrote the stage report to {report_path}")
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.cache import SQLiteCache
+from utils.kb_interface import KBClient, KBQueryError
+
+
+# Stand-in SPARQL endpoint. The query selects the behaviour: "bad" is answered with 400, "flaky" with 503
+# until it was requested twice, "slow" after a second, "close" with Connection: close and anything else
+# with {"query": <query>}. Every request is counted per query.
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        query = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())["query"][0]
+        with self.server.lock:
+            self.server.requests[query] += 1
+            count = self.server.requests[query]
+        if query == "slow":
+            time.sleep(1)
+        status, body = 200, json.dumps({"query": query}).encode()
+        if query == "bad":
+            status, body = 400, b"malformed query"
+        elif query == "flaky" and count <= 2:
+            status, body = 503, b"busy"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/sparql-results+json")
+        self.send_header("Content-Length", str(len(body)))
+        if query.startswith("close"):
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KBClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.requests = Counter()
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}/sparql"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        kwargs = dict({"max_workers": 4, "timeout": 5, "retries": 2, "backoff": 0}, **kwargs)
+        return KBClient(self.endpoint, **kwargs)
+
+    def test_responses_in_order_and_duplicates_sent_once(self):
+        queries = ["q1", "q2", "q1", "q3", "q2"]
+        latencies = []
+        with self.client() as client:
+            responses = client.query_many(queries, latencies=latencies)
+        self.assertEqual(responses, [{"query": query} for query in queries])
+        self.assertEqual(self.server.requests, Counter({"q1": 1, "q2": 1, "q3": 1}))
+        # only the first occurrence of a query was sent
+        self.assertEqual([latency is not None for latency in latencies], [True, True, False, True, False])
+
+    def test_retries_server_errors_only(self):
+        with self.client() as client:
+            self.assertEqual(client.query("flaky"), {"query": "flaky"})
+            self.assertEqual(self.server.requests["flaky"], 3)
+            self.assertEqual(client.stats["retries"], 2)
+            with self.assertRaises(KBQueryError):
+                client.query("bad")
+        self.assertEqual(self.server.requests["bad"], 1)
+
+    def test_timeout_and_return_exceptions(self):
+        with self.client(timeout=.2, retries=0) as client:
+            with self.assertRaises(KBQueryError):
+                client.query("slow")
+            latencies = []
+            responses = client.query_many(["q1", "bad", "q2"], return_exceptions=True, latencies=latencies)
+        self.assertEqual(responses[0], {"query": "q1"})
+        self.assertIsInstance(responses[1], KBQueryError)
+        self.assertEqual(responses[2], {"query": "q2"})
+        self.assertIsNone(latencies[1])
+
+    def test_responses_served_from_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache.sqlite")
+            with SQLiteCache(path) as cache, self.client(cache=cache) as client:
+                client.query_many(["q1", "q2", "bad"], return_exceptions=True)
+            with SQLiteCache(path) as cache, self.client(cache=cache) as client:
+                latencies = []
+                responses = client.query_many(["q1", "q2", "bad"], return_exceptions=True, latencies=latencies)
+                self.assertEqual(client.stats["cache_hits"], 2)
+        self.assertEqual(responses[:2], [{"query": "q1"}, {"query": "q2"}])
+        self.assertEqual(latencies, [None, None, None])
+        # failures are not cached
+        self.assertEqual(self.server.requests, Counter({"q1": 1, "q2": 1, "bad": 2}))
+
+    def test_connections_stay_bounded(self):
+        with self.client() as client:
+            client.query_many([f"close {i}" for i in range(200)] + [f"q{i}" for i in range(100)])
+            client.query_many(["bad"] * 3 + ["flaky"], return_exceptions=True)
+            self.assertLessEqual(len(client._connections), client.max_workers + 1)
+        self.assertEqual(client._connections, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import json
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+import preprocess
+
+
+# A raw LC-QuAD release of a few dozen questions, with a handful of unparsable queries that end up in the errors
+def write_raw_lcquad(raw_dir):
+    os.makedirs(os.path.join(raw_dir, "lcquad"))
+    for split, offset, n in (("train", 0, 40), ("test", 1000, 15)):
+        questions = []
+        for i in range(offset, offset + n):
+            sparql = (f"SELECT DISTINCT ?uri WHERE {{ ?uri <http://dbpedia.org/ontology/p{i % 7}> <http://dbpedia.org/resource/R{i % 5}> . "
+                      f"?uri <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://dbpedia.org/ontology/C{i % 3}> }}")
+            if i % 11 == 3:
+                sparql = "SELECT DISTINCT ?uri WHERE { ?uri"
+            questions.append({"_id": str(i), "corrected_question": f"question {i}?", "sparql_query": sparql})
+        with open(os.path.join(raw_dir, "lcquad", f"{split}-data.json"), "w") as f:
+            json.dump(questions, f)
+
+
+class ShardMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.raw_dir = os.path.join(self.tmp_dir.name, "raw")
+        write_raw_lcquad(self.raw_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def preprocess(self, name, *arguments):
+        data_dir = os.path.join(self.tmp_dir.name, name)
+        with redirect_stdout(StringIO()):
+            preprocess.main(["-t", "lcquad", "-d", data_dir, "--raw_dir", self.raw_dir, "--no_cache"] + list(arguments))
+        return data_dir
+
+    def read(self, data_dir, name):
+        with open(os.path.join(data_dir, name), "rb") as f:
+            return f.read()
+
+    def assert_merge_matches_single_node(self, *arguments):
+        single = self.preprocess("single", *arguments)
+        shards = [self.preprocess(f"shard_{i}", "--shard", f"{i}/2", *arguments) for i in range(2)]
+        # the shards are listed in any order
+        merged = self.preprocess("merged", "--merge", *reversed(shards), *arguments)
+        self.assertGreater(len(json.loads(self.read(single, "errors.json"))), 0)
+        for name in ("data_sets.json", "errors.json", "stats.txt"):
+            self.assertEqual(self.read(merged, name), self.read(single, name), name)
+
+    def test_in_memory(self):
+        self.assert_merge_matches_single_node()
+
+    def test_streaming_with_external_shuffle(self):
+        # chunks of 8 questions, so that the shuffle spills several runs to disk
+        self.assert_merge_matches_single_node("--streaming", "--chunk_size", "8")
+
+    def test_unshuffled(self):
+        self.assert_merge_matches_single_node("--shuffle", "")
+
+
+if __name__ == '__main__':
+    unittest.main()
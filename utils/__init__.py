@@ -3,4 +3,21 @@ import re
 
 big_bracket_pattern = re.compile(r'[{](.*?)[}]', re.S)
 
-angle_bracket_pattern = re.compile(r'[<](.*?)[>]', re.S)
\ No newline at end of file
+angle_bracket_pattern = re.compile(r'[<](.*?)[>]', re.S)
+
+# COUNT and the comparison operators <, <=, >, >= and != written with a space on both sides
+function_pattern = re.compile(r'COUNT|count| (<=|>=|!=|<|>)(?= )')
+
+count_variable_pattern = re.compile(r'(?:COUNT|count)\(\?[a-zA-Z0-9]+\)')
+
+variable_pattern = re.compile(r'\?[a-zA-Z0-9]+')
+
+count_call_pattern = re.compile(r'(?:COUNT\(|count\()')
+
+filter_call_pattern = re.compile(r'(?:FILTER\(|filter\()')
+
+t_number_pattern = re.compile(r't[0-9]+')
+
+or_pattern = re.compile(r'\ OR\ ')
+
+uri_pattern = re.compile(r'https?://[^\s<>"]+|www\.[^\s<>"]+')
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+import hashlib
+
+
+# bump whenever the extraction changes in a way that invalidates cached schema terms
+SCHEMA_TERMS_VERSION = 1
+
+# sqlite refuses statements with too many host parameters, so lookups are chunked
+_BATCH_SIZE = 500
+
+
+def normalize_sparql(sparql):
+    return sparql.strip()
+
+
+def sparql_hash(sparql):
+    return hashlib.sha256(normalize_sparql(sparql).encode("utf-8")).hexdigest()
+
+
+def schema_terms_key(flavour, kb, sparql):
+    return f"v{SCHEMA_TERMS_VERSION}:{flavour}:{kb}:{sparql_hash(sparql)}"
+
+
+# persistent key/value store holding JSON values. Every read or write stamps the entry with an
+# increasing tick, and once more than max_entries are stored the least recently used ones are evicted.
+class SQLiteCache:
+
+    def __init__(self, path, max_entries=2000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, tick INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_tick ON entries (tick)")
+        self.tick = self.conn.execute("SELECT COALESCE(MAX(tick), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_many(self, keys):
+        found = dict()
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), _BATCH_SIZE):
+            batch = keys[start:start + _BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(f"SELECT key, value FROM entries WHERE key IN ({placeholders})", batch)
+            for key, value in rows:
+                found[key] = json.loads(value)
+        if found:
+            self.tick += 1
+            self.conn.executemany("UPDATE entries SET tick = ? WHERE key = ?", [(self.tick, key) for key in found])
+            self.conn.commit()
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def put_many(self, items):
+        self.tick += 1
+        self.conn.executemany("INSERT OR REPLACE INTO entries (key, value, tick) VALUES (?, ?, ?)",
+                              [(key, json.dumps(value), self.tick) for key, value in items])
+        self.conn.commit()
+        self.evict()
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def evict(self):
+        overflow = len(self) - self.max_entries
+        if overflow > 0:
+            self.conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY tick LIMIT ?)", (overflow,))
+            self.conn.commit()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM entries")
+        self.conn.commit()
+        self.tick = 0
+
+    def close(self):
+        self.conn.close()
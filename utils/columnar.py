@@ -0,0 +1,150 @@
+import sys
+import json
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.json_writer import CHUNK_SIZE, frame_records, write_records
+from utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+PARQUET_MAGIC = b"PAR1"
+
+# columns of a preprocessed data set. schema_terms is stored as list<dictionary<string>> so that
+# every IRI is kept once per row group, the nested columns are stored as their JSON serialization.
+COLUMNS = ["id", "question", "query", "schema_terms", "answers"]
+JSON_COLUMNS = ["question", "query", "answers"]
+SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("question", pa.string()),
+    ("query", pa.string()),
+    ("schema_terms", pa.list_(pa.dictionary(pa.int32(), pa.string()))),
+    ("answers", pa.string()),
+])
+
+
+def is_parquet(path):
+    if path.endswith(".parquet"):
+        return True
+    with open(path, "rb") as f:
+        return f.read(len(PARQUET_MAGIC)) == PARQUET_MAGIC
+
+
+def _schema_terms_column(values):
+    terms = pa.array(values, type=pa.list_(pa.string()))
+    return pa.ListArray.from_arrays(terms.offsets, terms.values.dictionary_encode(), mask=terms.is_null())
+
+
+def frame_to_batch(frame):
+    # values go through the same JSON serialization as the json output of preprocess.py
+    return records_to_batch(list(frame_records(frame[COLUMNS], chunk_size=len(frame) or 1)))
+
+
+def records_to_batch(records):
+    columns = []
+    for name in COLUMNS:
+        values = [record[name] for record in records]
+        if name in JSON_COLUMNS:
+            columns.append(pa.array([json.dumps(value) for value in values], type=pa.string()))
+        elif name == "schema_terms":
+            columns.append(_schema_terms_column(values))
+        else:
+            columns.append(pa.array([None if value is None else str(value) for value in values], type=pa.string()))
+    return pa.record_batch(columns, schema=SCHEMA)
+
+
+def write_parquet(path, frame, chunk_size=CHUNK_SIZE):
+    with pq.ParquetWriter(path, SCHEMA) as writer:
+        for start in range(0, len(frame), chunk_size):
+            writer.write_batch(frame_to_batch(frame.iloc[start:start + chunk_size]))
+    return len(frame)
+
+
+# Writes records (as returned by frame_records) one at a time, like json_writer.RecordWriter, as row
+# groups of chunk_size records.
+class ParquetRecordWriter:
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.writer = pq.ParquetWriter(path, SCHEMA)
+        self.chunk_size = chunk_size
+        self.records = []
+        self.num_records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _flush(self):
+        if self.records:
+            self.writer.write_batch(records_to_batch(self.records))
+            self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+        self.num_records += 1
+        if len(self.records) >= self.chunk_size:
+            self._flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self._flush()
+        self.writer.close()
+        self.writer = None
+
+
+def read_table(path):
+    # memory-maps the file, the JSON columns are only decoded when records are built from them
+    return pq.read_table(path, memory_map=True)
+
+
+def record_lines(table, columns=("id", "question", "query", "answers", "schema_terms"), chunk_size=CHUNK_SIZE):
+    # one JSON line per row with the given columns, spliced from the stored JSON documents
+    for batch in table.select(list(columns)).to_batches(max_chunksize=chunk_size):
+        values = [batch.column(name).to_pylist() for name in columns]
+        for row in zip(*values):
+            fields = []
+            for name, value in zip(columns, row):
+                if name not in JSON_COLUMNS:
+                    value = json.dumps(value)
+                fields.append(json.dumps(name) + ":" + value)
+            yield "{" + ",".join(fields) + "}"
+
+
+def read_frame(table, columns=("id", "schema_terms")):
+    # the given columns as a frame, JSON columns are decoded to python objects
+    data = dict()
+    for name in columns:
+        values = table.column(name).to_pylist()
+        data[name] = [json.loads(value) for value in values] if name in JSON_COLUMNS else values
+    return pd.DataFrame(data, columns=list(columns))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="convert a preprocessed data set between json/jsonl and parquet.")
+    parser.add_argument("input_path", type=str, help="data_sets.json, data_sets.jsonl or data_sets.parquet.")
+    parser.add_argument("output_path", type=str, help="output file, the format is taken from its extension.")
+    args = parser.parse_args(arguments)
+
+    if is_parquet(args.input_path):
+        frame = read_frame(read_table(args.input_path), COLUMNS)
+    else:
+        frame = pd.read_json(args.input_path, orient="records", lines=args.input_path.endswith(".jsonl"))
+
+    if args.output_path.endswith(".parquet"):
+        write_parquet(args.output_path, frame)
+    else:
+        output_format = "jsonl" if args.output_path.endswith(".jsonl") else "json"
+        write_records(args.output_path, frame_records(frame), output_format=output_format)
+    print(f"converted {len(frame)} questions to {args.output_path}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
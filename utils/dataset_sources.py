@@ -0,0 +1,182 @@
+import os
+import json
+from itertools import islice
+from utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+
+# dataset loader scripts of the kgqa_datasets repository, per data set
+HUB_SCRIPTS = {
+    "qald": "kgqa_datasets/qald/qald.py",
+    "lcquad": "kgqa_datasets/lcquad_v1/lcquad_v1.py",
+    "lcquad2": "kgqa_datasets/lcquad_v2/lcquad_v2.py",
+}
+
+# files of the original releases, as downloaded by the loader scripts, per data set and split
+RAW_FILES = {
+    "qald": {"train": "qald-9-train-multilingual.json", "test": "qald-9-test-multilingual.json"},
+    "lcquad": {"train": "train-data.json", "test": "test-data.json"},
+    "lcquad2": {"train": "train.json", "test": "test.json"},
+}
+
+# characters read from a raw file at a time
+CHUNK_SIZE = 1 << 20
+
+
+class _JSONStream:
+    # decodes the values of a JSON document one at a time from a file read in chunks
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        # the next non-whitespace character, "" at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"expected one of {chars!r} in {self.f.name}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # the value continues in the next chunk
+                if not self._fill():
+                    raise
+                continue
+            # so may a number ending the buffer, e.g. 7.5 of 7.5e3
+            if isinstance(value, (int, float)) and not self.buffer[end:].strip("0123456789.eE+-") and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(path, key=None, chunk_size=CHUNK_SIZE):
+    # the elements of the top-level array of a JSON file, or of the array under `key` of its top-level
+    # object, decoded one at a time instead of loading the whole document
+    with open(path, encoding="utf-8") as f:
+        stream = _JSONStream(f, chunk_size)
+        if key is not None:
+            stream.expect("{")
+            while True:
+                name = stream.value()
+                stream.expect(":")
+                if name == key:
+                    break
+                stream.value()
+                if stream.expect(",}") == "}":
+                    raise KeyError(f"{key} not found in {path}")
+        stream.expect("[")
+        if stream.peek() == "]":
+            return
+        while True:
+            yield stream.value()
+            if stream.expect(",]") == "]":
+                return
+
+
+def _qald_rows(path, config_name):
+    # question and answers are JSON encoded, as the loader script does
+    for question in iter_json_array(path, key="questions"):
+        yield {
+            "id": question["id"],
+            "question": json.dumps(question["question"]),
+            "query": {"sparql": question["query"].get("sparql")},
+            "answers": json.dumps(question.get("answers", [])),
+        }
+
+
+def _lcquad_rows(path, config_name):
+    for question in iter_json_array(path):
+        yield {
+            "_id": question["_id"],
+            "corrected_question": question["corrected_question"],
+            "sparql_query": question["sparql_query"],
+        }
+
+
+def _lcquad2_rows(path, config_name):
+    # config_name is lcquad2-dbpedia or lcquad2-wikidata, the raw files hold the queries for both
+    kb = config_name.split("-", 1)[1]
+    for question in iter_json_array(path):
+        yield {
+            "uid": question["uid"],
+            "question": question["question"],
+            "sparql": question["sparql_dbpedia18" if kb == "dbpedia" else "sparql_wikidata"],
+            "answer": question.get("answer", []),
+        }
+
+
+RAW_READERS = {"qald": _qald_rows, "lcquad": _lcquad_rows, "lcquad2": _lcquad2_rows}
+
+
+# Where preprocess.py loads the data sets from. Both sources yield the columns of the loader scripts, so
+# the processing does not depend on the source.
+class HubSource:
+    # runs the loader scripts of the kgqa_datasets repository with Hugging Face datasets
+
+    def load(self, name, config_name, split, columns):
+        datasets = lazy_import("datasets")
+        return datasets.load_dataset(HUB_SCRIPTS[name], config_name, split=split).to_pandas()[columns]
+
+    def load_chunks(self, name, config_name, split, columns, chunk_size):
+        # the dataset is memory-mapped arrow, only a chunk of it is converted to pandas at a time
+        datasets = lazy_import("datasets")
+        dataset = datasets.load_dataset(HUB_SCRIPTS[name], config_name, split=split)
+        for chunk in dataset.to_pandas(batch_size=chunk_size, batched=True):
+            yield chunk[columns]
+
+
+class LocalSource:
+    # reads the raw files of the original releases from <raw_dir>/<name>/, without datasets and offline
+
+    def __init__(self, raw_dir):
+        self.raw_dir = raw_dir
+
+    def path(self, name, split):
+        return os.path.join(self.raw_dir, name, RAW_FILES[name][split])
+
+    def load(self, name, config_name, split, columns):
+        return next(self.load_chunks(name, config_name, split, columns))
+
+    def load_chunks(self, name, config_name, split, columns, chunk_size=None):
+        # frames of chunk_size questions (all of them if None), filled column by column so that only one
+        # raw question is held as a dict at a time
+        rows = RAW_READERS[name](self.path(name, split), config_name)
+        while True:
+            data = {column: [] for column in columns}
+            for row in islice(rows, chunk_size):
+                for column in columns:
+                    data[column].append(row[column])
+            num_rows = len(data[columns[0]])
+            if num_rows or chunk_size is None:
+                yield pd.DataFrame(data, columns=columns)
+            if chunk_size is None or num_rows < chunk_size:
+                return
+
+
+def get_source(raw_dir=None):
+    return HubSource() if raw_dir is None else LocalSource(raw_dir)
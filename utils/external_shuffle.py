@@ -0,0 +1,96 @@
+import os
+import json
+import hashlib
+import tempfile
+from utils.json_writer import CHUNK_SIZE
+
+
+# number of buckets the records are spilled to, one per value of a byte of the key
+FANOUT = 256
+KEY_SIZE = 16
+
+
+def shuffle_key(id, random_seed):
+    return hashlib.blake2b(f"{random_seed}:{id}".encode("utf-8"), digest_size=KEY_SIZE).hexdigest()
+
+
+# Deterministic out-of-core shuffle. Every record is keyed by a hash of its id under the random seed and
+# appended to a bucket file chosen by the first byte of its key. The buckets are then read back one at a
+# time and sorted by key, so that the records come out ordered by key, i.e. in an order that only depends
+# on the ids and the seed. A bucket of more than max_rows records is spilled again by the next byte of
+# the key, so that at most max_rows records are held in memory whatever the number of records.
+class ExternalShuffle:
+
+    def __init__(self, random_seed, max_rows=CHUNK_SIZE, dir=None):
+        self.random_seed = random_seed
+        self.max_rows = max_rows
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="shuffle_", dir=dir)
+        self.buckets = [None] * FANOUT
+        self.counts = [0] * FANOUT
+        self.num_records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _bucket_path(self, prefix):
+        return os.path.join(self.tmp_dir.name, prefix or "root")
+
+    def add(self, id, record):
+        key = shuffle_key(id, self.random_seed)
+        bucket = int(key[:2], 16)
+        if self.buckets[bucket] is None:
+            self.buckets[bucket] = open(self._bucket_path(key[:2]), "w")
+        self.buckets[bucket].write(key + "\t" + json.dumps(record) + "\n")
+        self.counts[bucket] += 1
+        self.num_records += 1
+
+    def add_many(self, ids, records):
+        for id, record in zip(ids, records):
+            self.add(id, record)
+
+    def _drain(self, prefix, count):
+        path = self._bucket_path(prefix)
+        depth = len(prefix)
+        if count <= self.max_rows or depth >= 2 * KEY_SIZE:
+            with open(path) as f:
+                lines = f.readlines()
+            os.remove(path)
+            # stable, so that records with the same id keep the order they were added in
+            lines.sort(key=lambda line: line[:2 * KEY_SIZE])
+            for line in lines:
+                yield json.loads(line[2 * KEY_SIZE + 1:])
+            return
+
+        sub_buckets = dict()
+        counts = [0] * FANOUT
+        with open(path) as f:
+            for line in f:
+                sub_bucket = int(line[depth:depth + 2], 16)
+                if sub_bucket not in sub_buckets:
+                    sub_buckets[sub_bucket] = open(self._bucket_path(line[:depth + 2]), "w")
+                sub_buckets[sub_bucket].write(line)
+                counts[sub_bucket] += 1
+        os.remove(path)
+        for f in sub_buckets.values():
+            f.close()
+        for sub_bucket in sorted(sub_buckets):
+            yield from self._drain(prefix + "%02x" % sub_bucket, counts[sub_bucket])
+
+    def records(self):
+        # the shuffled records, each bucket is removed once it has been read
+        for bucket, f in enumerate(self.buckets):
+            if f is None:
+                continue
+            f.close()
+            self.buckets[bucket] = None
+            yield from self._drain("%02x" % bucket, self.counts[bucket])
+
+    def close(self):
+        for f in self.buckets:
+            if f is not None:
+                f.close()
+        self.buckets = [None] * FANOUT
+        self.tmp_dir.cleanup()
@@ -0,0 +1,389 @@
+import re
+from functools import lru_cache
+
+from rdflib import RDF, XSD, Literal, URIRef, Variable
+from rdflib.plugins.sparql.sparql import Prologue
+from rdflib.plugins.sparql.algebra import reorderTriples
+
+
+# A tokenizer based extractor of the basic graph pattern triples for the simple query shapes
+# found in LC-QuAD and QALD: PREFIX declarations, SELECT/ASK with a single group of triples and
+# FILTER constraints, and the usual solution modifiers. The terms are built exactly like rdflib
+# builds them and the triples are ordered with rdflib's own reorderTriples, so the result equals
+# extract_triples(query) without running pyparsing and the algebra translation.
+# Anything outside of that subset (UNION, OPTIONAL, sub-queries, paths, blank nodes, escapes,
+# comments, ...) makes extract_triples_fast return None and the caller falls back to rdflib.
+
+
+class _Unsupported(Exception):
+    pass
+
+
+_TOKEN_PATTERN = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<iri><[^<>"{}|^`\\\x00-\x20]*>)
+  | (?P<var>[?$][A-Za-z0-9_]+)
+  | (?P<pname>(?:[A-Za-z](?:[A-Za-z0-9_\-.]*[A-Za-z0-9_\-])?)?:(?:[A-Za-z0-9_:](?:[A-Za-z0-9_\-.:]*[A-Za-z0-9_\-:])?)?)
+  | (?P<string>'[^'\n\r\\]*'(?!')|"[^"\n\r\\]*"(?!"))
+  | (?P<double>[0-9]+\.[0-9]*[eE][+-]?[0-9]+|\.[0-9]+[eE][+-]?[0-9]+|[0-9]+[eE][+-]?[0-9]+)
+  | (?P<decimal>[0-9]*\.[0-9]+)
+  | (?P<integer>[0-9]+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op><=|>=|!=|&&|\|\||\^\^|[{}().;,*=<>!@])
+""", re.X)
+
+# characters that may not directly follow a variable, prefixed name, number or keyword
+# without making the token longer in the SPARQL grammar than it is in the pattern above
+_BOUNDARY_PATTERN = re.compile(r"[^\s{}().;,=<>!&|]")
+
+_LANGTAG_PATTERN = re.compile(r"[a-zA-Z]+(?:-[a-zA-Z0-9]+)*")
+
+_NUMERIC_TYPES = {"double": XSD.double, "decimal": XSD.decimal, "integer": XSD.integer}
+
+_RELATIONAL_OPERATORS = {"=", "!=", "<", ">", "<=", ">="}
+
+# builtin functions allowed in FILTER constraints, with the number of arguments they accept
+_BUILTINS = {
+    "LANG": (1,), "LANGMATCHES": (2,), "STR": (1,), "LCASE": (1,), "UCASE": (1,), "STRLEN": (1,),
+    "CONTAINS": (2,), "STRSTARTS": (2,), "STRENDS": (2,), "REGEX": (2, 3), "YEAR": (1,), "MONTH": (1,),
+    "DAY": (1,), "BOUND": (1,), "ISIRI": (1,), "ISURI": (1,), "ISLITERAL": (1,), "DATATYPE": (1,),
+}
+
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    length = len(query)
+    while pos < length:
+        match = _TOKEN_PATTERN.match(query, pos)
+        if match is None:
+            raise _Unsupported(query[pos:pos + 10])
+        kind = match.lastgroup
+        end = match.end()
+        if kind in ("var", "pname", "word", "double", "decimal", "integer") and end < length \
+                and _BOUNDARY_PATTERN.match(query, end) and query[end] != ".":
+            raise _Unsupported(query[pos:end + 1])
+        if kind == "op" and match.group() == "@":
+            # language tags only follow a string literal directly
+            if not tokens or tokens[-1][0] != "string" or tokens[-1][2] != pos:
+                raise _Unsupported("@")
+            tag = _LANGTAG_PATTERN.match(query, end)
+            if tag is None:
+                raise _Unsupported("@")
+            tokens.append(("langtag", tag.group(), tag.end()))
+            pos = tag.end()
+            continue
+        if kind != "ws":
+            tokens.append((kind, match.group(), end))
+        pos = end
+    return tokens
+
+
+@lru_cache(maxsize=256)
+def _prologue(prefixes):
+    prologue = Prologue()
+    prologue.base = ""
+    for prefix, iri in prefixes:
+        prologue.bind(prefix, prologue.absolutize(URIRef(iri)))
+    return prologue
+
+
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.prologue = None
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return ("eof", "", -1)
+
+    def next(self):
+        token = self.peek()
+        if token[0] == "eof":
+            raise _Unsupported("unexpected end of query")
+        self.pos += 1
+        return token
+
+    def is_op(self, value, offset=0):
+        kind, text, _ = self.peek(offset)
+        return kind == "op" and text == value
+
+    def is_word(self, value, offset=0):
+        kind, text, _ = self.peek(offset)
+        return kind == "word" and text.upper() == value
+
+    def expect_op(self, value):
+        if not self.is_op(value):
+            raise _Unsupported(value)
+        self.pos += 1
+
+    def expect_word(self, value):
+        if not self.is_word(value):
+            raise _Unsupported(value)
+        self.pos += 1
+
+    def parse(self):
+        prefixes = []
+        while self.is_word("PREFIX"):
+            self.pos += 1
+            kind, text, _ = self.next()
+            if kind != "pname" or not text.endswith(":") or text.count(":") != 1:
+                raise _Unsupported(text)
+            kind, iri, _ = self.next()
+            if kind != "iri":
+                raise _Unsupported(iri)
+            prefixes.append((text[:-1], iri[1:-1]))
+        self.prologue = _prologue(tuple(prefixes))
+
+        if self.is_word("SELECT"):
+            self.pos += 1
+            projection = self.parse_projection()
+        elif self.is_word("ASK"):
+            self.pos += 1
+            projection = None
+        else:
+            raise _Unsupported(self.peek()[1])
+
+        if self.is_word("WHERE"):
+            self.pos += 1
+        triples = self.parse_group()
+        self.parse_modifiers(projection)
+        if self.peek()[0] != "eof":
+            raise _Unsupported(self.peek()[1])
+
+        # rdflib sorts the merged BGP once more when simplifying the algebra, and as the sort only
+        # depends on the set of triples, sorting all of them once gives the same order
+        return reorderTriples(triples)
+
+    def parse_projection(self):
+        if self.is_word("DISTINCT") or self.is_word("REDUCED"):
+            self.pos += 1
+        if self.is_op("*"):
+            self.pos += 1
+            return "*"
+        if self.is_op("("):
+            # a single (COUNT([DISTINCT] ?var|*) AS ?var) projection
+            self.pos += 1
+            self.expect_word("COUNT")
+            self.expect_op("(")
+            if self.is_word("DISTINCT"):
+                self.pos += 1
+            if self.is_op("*"):
+                self.pos += 1
+            elif self.next()[0] != "var":
+                raise _Unsupported("COUNT")
+            self.expect_op(")")
+            self.expect_word("AS")
+            if self.next()[0] != "var":
+                raise _Unsupported("AS")
+            self.expect_op(")")
+            if self.peek()[0] == "var" or self.is_op("("):
+                raise _Unsupported("mixed projection")
+            return "count"
+        variables = []
+        while self.peek()[0] == "var":
+            variables.append(self.next()[1][1:])
+        if not variables or self.is_op("("):
+            raise _Unsupported("projection")
+        return variables
+
+    def parse_group(self):
+        self.expect_op("{")
+        triples = []
+        while True:
+            if self.is_op("}"):
+                self.pos += 1
+                return triples
+            if self.is_word("FILTER"):
+                self.pos += 1
+                self.parse_constraint()
+                if self.is_op("."):
+                    self.pos += 1
+                continue
+            self.parse_triples_same_subject(triples)
+            if self.is_op("."):
+                self.pos += 1
+            elif not (self.is_op("}") or self.is_word("FILTER")):
+                raise _Unsupported(self.peek()[1])
+
+    def parse_triples_same_subject(self, triples):
+        kind, text, _ = self.peek()
+        if kind not in ("var", "iri", "pname"):
+            raise _Unsupported(text)
+        subject = self.parse_term()
+        while True:
+            predicate = self.parse_verb()
+            while True:
+                triples.append((subject, predicate, self.parse_object()))
+                if not self.is_op(","):
+                    break
+                self.pos += 1
+            while self.is_op(";"):
+                self.pos += 1
+            if self.peek()[0] in ("var", "iri", "pname") or (self.peek()[0] == "word" and self.peek()[1] == "a"):
+                # a verb may only follow a ';'
+                if not self.is_op(";", -1):
+                    raise _Unsupported(self.peek()[1])
+                continue
+            return
+
+    def parse_verb(self):
+        kind, text, _ = self.peek()
+        if kind == "word" and text == "a":
+            self.pos += 1
+            return RDF.type
+        if kind not in ("var", "iri", "pname"):
+            raise _Unsupported(text)
+        return self.parse_term()
+
+    def parse_object(self):
+        kind, text, _ = self.peek()
+        if kind in ("var", "iri", "pname"):
+            return self.parse_term()
+        return self.parse_literal()
+
+    def parse_term(self):
+        kind, text, _ = self.next()
+        if kind == "var":
+            return Variable(text[1:])
+        if kind == "iri":
+            return self.prologue.absolutize(URIRef(text[1:-1]))
+        if kind == "pname":
+            prefix, localname = text.split(":", 1)
+            try:
+                return self.prologue.resolvePName(prefix, localname)
+            except Exception:
+                raise _Unsupported(text)
+        raise _Unsupported(text)
+
+    def parse_literal(self):
+        kind, text, end = self.next()
+        if kind in _NUMERIC_TYPES:
+            return Literal(text, datatype=_NUMERIC_TYPES[kind])
+        if kind == "word" and text in ("true", "false"):
+            return Literal(text == "true")
+        if kind != "string":
+            raise _Unsupported(text)
+        value = text[1:-1]
+        next_kind, next_text, next_end = self.peek()
+        if next_kind == "langtag":
+            self.pos += 1
+            return Literal(value, lang=next_text)
+        if next_kind == "op" and next_text == "^^" and next_end == end + 2:
+            self.pos += 1
+            kind, text, datatype_end = self.peek()
+            if kind not in ("iri", "pname") or datatype_end != next_end + len(text):
+                raise _Unsupported(text)
+            return Literal(value, datatype=self.parse_term())
+        return Literal(value)
+
+    def parse_constraint(self):
+        if self.is_op("("):
+            self.pos += 1
+            self.parse_expression()
+            self.expect_op(")")
+        elif self.peek()[0] == "word" and self.peek()[1].upper() in _BUILTINS:
+            self.parse_builtin()
+        else:
+            raise _Unsupported("FILTER")
+
+    def parse_expression(self):
+        self.parse_and()
+        while self.is_op("||"):
+            self.pos += 1
+            self.parse_and()
+
+    def parse_and(self):
+        self.parse_relational()
+        while self.is_op("&&"):
+            self.pos += 1
+            self.parse_relational()
+
+    def parse_relational(self):
+        self.parse_unary()
+        kind, text, _ = self.peek()
+        if kind == "op" and text in _RELATIONAL_OPERATORS:
+            self.pos += 1
+            self.parse_unary()
+
+    def parse_unary(self):
+        if self.is_op("!"):
+            self.pos += 1
+            self.parse_unary()
+            return
+        kind, text, _ = self.peek()
+        if kind == "op" and text == "(":
+            self.pos += 1
+            self.parse_expression()
+            self.expect_op(")")
+        elif kind in ("var", "iri", "pname"):
+            self.parse_term()
+        elif kind == "word" and text.upper() in _BUILTINS:
+            self.parse_builtin()
+        else:
+            self.parse_literal()
+
+    def parse_builtin(self):
+        name = self.next()[1].upper()
+        self.expect_op("(")
+        arguments = 0
+        if name == "BOUND":
+            if self.next()[0] != "var":
+                raise _Unsupported(name)
+            arguments = 1
+        else:
+            while True:
+                self.parse_expression()
+                arguments += 1
+                if not self.is_op(","):
+                    break
+                self.pos += 1
+        self.expect_op(")")
+        if arguments not in _BUILTINS[name]:
+            raise _Unsupported(name)
+
+    def parse_modifiers(self, projection):
+        if self.is_word("GROUP"):
+            self.pos += 1
+            self.expect_word("BY")
+            group_variables = []
+            while self.peek()[0] == "var":
+                group_variables.append(self.next()[1][1:])
+            if not group_variables:
+                raise _Unsupported("GROUP BY")
+            if projection != "count" and (not isinstance(projection, list) or not set(projection) <= set(group_variables)):
+                raise _Unsupported("GROUP BY")
+        if self.is_word("ORDER"):
+            self.pos += 1
+            self.expect_word("BY")
+            conditions = 0
+            while True:
+                if self.is_word("ASC") or self.is_word("DESC"):
+                    self.pos += 1
+                    self.expect_op("(")
+                    if self.next()[0] != "var":
+                        raise _Unsupported("ORDER BY")
+                    self.expect_op(")")
+                elif self.peek()[0] == "var":
+                    self.pos += 1
+                else:
+                    break
+                conditions += 1
+            if conditions == 0:
+                raise _Unsupported("ORDER BY")
+        seen = set()
+        while self.is_word("LIMIT") or self.is_word("OFFSET"):
+            keyword = self.next()[1].upper()
+            if keyword in seen or self.next()[0] != "integer":
+                raise _Unsupported(keyword)
+            seen.add(keyword)
+
+
+def extract_triples_fast(query):
+    try:
+        return _Parser(_tokenize(query)).parse()
+    except _Unsupported:
+        return None
@@ -0,0 +1,84 @@
+import json
+
+
+OUTPUT_FORMATS = ["json", "compact", "jsonl"]
+
+# number of rows serialized by pandas at a time when streaming a frame
+CHUNK_SIZE = 10000
+
+
+def output_extension(output_format):
+    return ".jsonl" if output_format == "jsonl" else ".json"
+
+
+def frame_records(frame, chunk_size=CHUNK_SIZE):
+    # the rows of a frame as python objects, as json.loads(frame.to_json(orient="records")) would
+    # return them, serialized a chunk of rows at a time
+    for start in range(0, len(frame), chunk_size):
+        lines = frame.iloc[start:start + chunk_size].to_json(orient="records", lines=True)
+        for line in lines.split("\n"):
+            if line:
+                yield json.loads(line)
+
+
+# Writes records one at a time, either as the questions of a {"dataset": {...}, "questions": [...]}
+# envelope (when dataset is given) or as a bare JSON array. The "json" format is byte-identical to
+# json.dump(..., indent=2) of the whole document, "compact" drops all whitespace and "jsonl" writes one
+# record per line without the envelope.
+class RecordWriter:
+
+    def __init__(self, path, dataset=None, output_format="json"):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"unknown output format: {output_format}")
+        self.output_format = output_format
+        self.file = open(path, "w")
+        self.num_records = 0
+
+        if output_format == "json":
+            self.indent = "    " if dataset is not None else "  "
+            head = "{\n  \"dataset\": " + self._dumps(dataset, "  ") + ",\n  \"questions\": [" if dataset is not None else "["
+            self.tail = ("\n  ]\n}", "]\n}") if dataset is not None else ("\n]", "]")
+        elif output_format == "compact":
+            head = "{\"dataset\":" + self._dumps(dataset) + ",\"questions\":[" if dataset is not None else "["
+            self.tail = ("]}", "]}") if dataset is not None else ("]", "]")
+        else:
+            head = ""
+            self.tail = ("", "")
+        self.file.write(head)
+
+    def _dumps(self, obj, indent=""):
+        if self.output_format == "json":
+            return json.dumps(obj, indent=2).replace("\n", "\n" + indent)
+        return json.dumps(obj, separators=(",", ":"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, record):
+        if self.output_format == "json":
+            self.file.write(("\n" if self.num_records == 0 else ",\n") + self.indent + self._dumps(record, self.indent))
+        elif self.output_format == "compact":
+            self.file.write(("" if self.num_records == 0 else ",") + self._dumps(record))
+        else:
+            self.file.write(json.dumps(record) + "\n")
+        self.num_records += 1
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.write(self.tail[0] if self.num_records else self.tail[1])
+        self.file.close()
+        self.file = None
+
+
+def write_records(path, records, dataset=None, output_format="json"):
+    with RecordWriter(path, dataset, output_format) as writer:
+        writer.write_many(records)
+    return writer.num_records
@@ -1,10 +1,190 @@
-
+import json
+import time
+import socket
+import threading
+import http.client
+from collections import Counter
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
 from SPARQLWrapper import SPARQLWrapper, JSON
+from utils.cache import sparql_hash
 
-def KB_query(_query, kb_endpoint):
+def KB_query(_query, kb_endpoint, timeout=None):
     sparql = SPARQLWrapper(kb_endpoint)
     sparql.setQuery(_query)
     sparql.setReturnFormat(JSON)
-    # sparql.setTimeout(5)
+    if timeout is not None:
+        sparql.setTimeout(timeout)
     response = sparql.query().convert()
-    return response
\ No newline at end of file
+    return response
+
+
+class KBQueryError(Exception):
+    pass
+
+
+# HTTP statuses worth retrying, everything else (e.g. 400 for a malformed query) fails at once
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# SPARQL endpoint client for running many queries. Every worker thread keeps its own keep-alive
+# connection, requests time out after `timeout` seconds and are retried with exponential backoff, and
+# successful responses are stored in an optional SQLiteCache keyed by endpoint and query hash. The cache
+# is only touched from the calling thread.
+class KBClient:
+
+    def __init__(self, kb_endpoint, max_workers=16, timeout=30, retries=3, backoff=.5, cache=None):
+        url = urlsplit(kb_endpoint)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"unsupported endpoint: {kb_endpoint}")
+        self.kb_endpoint = kb_endpoint
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache = cache
+        self.stats = Counter()
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def cache_key(self, query):
+        return f"kb:{self.kb_endpoint}:{sparql_hash(query)}"
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self.connection_class(self.netloc, timeout=self.timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _reset_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._lock:
+                self._connections.remove(connection)
+
+    def _request(self, query):
+        body = urlencode({"query": query})
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/sparql-results+json,application/json",
+        }
+        connection = self._connection()
+        connection.request("POST", self.path, body=body, headers=headers)
+        response = connection.getresponse()
+        # the body has to be read completely before the connection can be reused
+        data = response.read()
+        if response.getheader("Connection", "").lower() == "close":
+            self._reset_connection()
+        return response.status, data
+
+    def execute(self, query):
+        # runs a query against the endpoint, bypassing the cache
+        return self._execute(query)[0]
+
+    def _execute(self, query):
+        # the response and the latency in seconds of a query, including retries
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count("retries")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                status, data = self._request(query)
+            except (socket.timeout, ConnectionError, http.client.HTTPException, OSError) as e:
+                self._reset_connection()
+                error = KBQueryError(f"{type(e).__name__}: {e}")
+                continue
+            if status == 200:
+                self._count("requests")
+                latency = time.perf_counter() - start
+                try:
+                    return json.loads(data), latency
+                except ValueError as e:
+                    error = KBQueryError(f"invalid response: {e}")
+                    break
+            error = KBQueryError(f"HTTP {status}: {data[:200].decode('utf-8', 'replace')}")
+            if status not in RETRY_STATUSES:
+                break
+        self._count("failures")
+        raise error
+
+    def query(self, query):
+        return self.query_many([query])[0]
+
+    def query_many(self, queries, return_exceptions=False, latencies=None):
+        # responses in the order of the queries. Identical queries are sent once, and with
+        # return_exceptions=True failed queries yield their KBQueryError instead of raising it. A list
+        # passed as latencies is filled with the latency of every query, None unless this call sent it
+        # to the endpoint (served from the cache, a repetition of an earlier query or failed).
+        queries = list(queries)
+        distinct = list(dict.fromkeys(queries))
+        responses = dict()
+        if self.cache is not None:
+            cached = self.cache.get_many([self.cache_key(query) for query in distinct])
+            for query in distinct:
+                if self.cache_key(query) in cached:
+                    responses[query] = cached[self.cache_key(query)]
+            self._count("cache_hits", len(responses))
+
+        def run(query):
+            try:
+                return self._execute(query)
+            except KBQueryError as e:
+                return e, None
+
+        missing = [query for query in distinct if query not in responses]
+        if len(missing) == 1 or self.max_workers <= 1:
+            results = [run(query) for query in missing]
+        elif missing:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            results = list(self._executor.map(run, missing))
+        else:
+            results = []
+        sent = {query: latency for query, (_, latency) in zip(missing, results)}
+        results = [response for response, _ in results]
+        responses.update(zip(missing, results))
+
+        if self.cache is not None:
+            self.cache.put_many([(self.cache_key(query), response) for query, response in zip(missing, results)
+                                 if not isinstance(response, KBQueryError)])
+
+        if not return_exceptions:
+            for query in distinct:
+                if isinstance(responses[query], KBQueryError):
+                    raise responses[query]
+        if latencies is not None:
+            for query in queries:
+                latencies.append(sent.pop(query, None))
+        return [responses[query] for query in queries]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
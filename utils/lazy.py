@@ -0,0 +1,30 @@
+import sys
+import importlib.util
+import importlib.machinery
+
+
+# specs of the modules created by lazy_import, their submodules are looked up in them so that a parent
+# package is not loaded just to find a submodule
+_specs = dict()
+
+
+def lazy_import(name):
+    # the module, which is only executed on the first access to one of its attributes. The CLIs bind
+    # pandas, sklearn, rdflib and datasets this way so that they start (e.g. for --help) without them.
+    if name in sys.modules:
+        return sys.modules[name]
+    parent, _, _ = name.rpartition(".")
+    if parent:
+        lazy_import(parent)
+        parent_spec = _specs.get(parent) or sys.modules[parent].__spec__
+        spec = importlib.machinery.PathFinder.find_spec(name, parent_spec.submodule_search_locations)
+    else:
+        spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    _specs[name] = spec
+    spec.loader.exec_module(module)
+    return module
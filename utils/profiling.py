@@ -0,0 +1,126 @@
+import sys
+import json
+import time
+import resource
+from collections import Counter
+from contextlib import contextmanager
+
+
+# --profile stages only writes the stage report, cprofile and pyinstrument additionally dump a profile
+PROFILERS = ["stages", "cprofile", "pyinstrument"]
+PROFILE_EXTENSIONS = {"cprofile": ".prof", "pyinstrument": ".html"}
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.peak_rss_mb = 0.0
+        self.counts = Counter()
+
+    def count(self, key, n=1):
+        self.counts[key] += n
+
+    def report(self):
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "rows_per_sec": self.rows / self.seconds if self.seconds else None,
+            "peak_rss_mb": self.peak_rss_mb,
+            "counts": dict(self.counts),
+        }
+
+
+# Wall time, rows, peak memory and event counts (parse fallbacks, errors, ...) of the stages of a run.
+# A stage entered several times accumulates, and stages may nest, e.g. "lcquad/extract" within "lcquad".
+# The peak RSS of a stage is the one of the process when it ended, the workers are reported as a whole.
+class StageProfiler:
+
+    def __init__(self):
+        self.stages = dict()
+        self.started = time.perf_counter()
+        self._profiler = None
+        self._kind = None
+
+    def clear(self):
+        self.stages = dict()
+        self.started = time.perf_counter()
+
+    def get(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        stage = self.get(name)
+        stage.rows += rows
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.calls += 1
+            stage.seconds += time.perf_counter() - start
+            stage.peak_rss_mb = peak_rss_mb()
+
+    def iterate(self, name, iterable, rows=None):
+        # times the production of every item of a lazy iterable, counting rows(item) rows per item (one
+        # by default)
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                stage.rows += 1 if rows is None else rows(item)
+            yield item
+
+    def report(self, **extra):
+        return dict(extra, **{
+            "seconds": time.perf_counter() - self.started,
+            "peak_rss_mb": peak_rss_mb(),
+            "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "stages": {name: stage.report() for name, stage in self.stages.items()},
+        })
+
+    def write(self, path, **extra):
+        with open(path, "w") as f:
+            json.dump(self.report(**extra), f, indent=2)
+
+    def enable(self, kind):
+        # profiles the functions called until dump() with cProfile or pyinstrument (if installed)
+        self._kind = kind
+        if kind == "cprofile":
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif kind == "pyinstrument":
+            from pyinstrument import Profiler
+            self._profiler = Profiler()
+            self._profiler.start()
+
+    def dump(self, path_prefix):
+        # returns the path of the dump, if any
+        if self._profiler is None:
+            return None
+        path = path_prefix + PROFILE_EXTENSIONS[self._kind]
+        if self._kind == "cprofile":
+            self._profiler.disable()
+            self._profiler.dump_stats(path)
+        else:
+            self._profiler.stop()
+            with open(path, "w") as f:
+                f.write(self._profiler.output_html())
+        self._profiler = None
+        return path
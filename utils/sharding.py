@@ -0,0 +1,95 @@
+import os
+import json
+import heapq
+import hashlib
+import argparse
+import numpy as np
+from utils.json_writer import RecordWriter
+
+# manifest of the outputs of a --shard run, read by --merge
+MANIFEST = "shard.json"
+
+# positions read from a positions file at a time
+POSITIONS_CHUNK = 1 << 16
+
+
+def parse_shard(value):
+    # i/N of --shard, with 0 <= i < N
+    index, _, num_shards = value.partition("/")
+    try:
+        index, num_shards = int(index), int(num_shards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value!r}")
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f"expected 0 <= i < N, got {value!r}")
+    return index, num_shards
+
+
+def shard_of(id, num_shards):
+    return int.from_bytes(hashlib.blake2b(str(id).encode("utf-8"), digest_size=8).digest(), "little") % num_shards
+
+
+def shard_mask(ids, shard):
+    # whether every id belongs to the shard (index, num_shards)
+    index, num_shards = shard
+    return np.fromiter((shard_of(id, num_shards) == index for id in ids), dtype=bool, count=len(ids))
+
+
+# The records of a shard as jsonl, in the order of a single-node run, and the position of every record in
+# that run, (task, row of the task) as two int64 in <path>.positions, so that the shards can be merged back
+# into that order.
+class ShardOutput:
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = RecordWriter(path + ".jsonl", output_format="jsonl")
+        self.positions = open(path + ".positions", "wb")
+        self.num_records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_many(self, records, task, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        self.writer.write_many(records)
+        self.positions.write(np.column_stack([np.full(len(rows), task, dtype=np.int64), rows]).tobytes())
+        self.num_records += len(rows)
+
+    def close(self):
+        self.writer.close()
+        self.positions.close()
+
+
+def read_shard_output(path):
+    # ((task, row), record) of every record written by a ShardOutput, in the order they were written
+    with open(path + ".jsonl", encoding="utf-8") as records, open(path + ".positions", "rb") as positions:
+        while True:
+            chunk = np.frombuffer(positions.read(16 * POSITIONS_CHUNK), dtype=np.int64).reshape(-1, 2)
+            if not len(chunk):
+                return
+            for task, row in chunk.tolist():
+                yield (task, row), json.loads(records.readline())
+
+
+def merge_shard_outputs(paths):
+    # ((task, row), record) of the records of all shards in the order of a single-node run. Every shard is
+    # in that order already, so only one record per shard is held at a time.
+    return heapq.merge(*[read_shard_output(path) for path in paths], key=lambda item: item[0])
+
+
+def read_manifests(shard_dirs):
+    # the manifests of the shard directories, which must hold every shard of the same run exactly once
+    manifests = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, MANIFEST)) as f:
+            manifests.append(json.load(f))
+    num_shards = manifests[0]["num_shards"]
+    if sorted(manifest["shard"] for manifest in manifests) != list(range(num_shards)):
+        raise ValueError(f"expected the shards 0 to {num_shards - 1} once each, got {[m['shard'] for m in manifests]}")
+    for manifest in manifests:
+        if manifest["num_shards"] != num_shards or manifest["tasks"] != manifests[0]["tasks"]:
+            raise ValueError(f"shard {manifest['shard']} was run with other tasks or another number of shards")
+    return manifests
@@ -0,0 +1,97 @@
+import json
+from itertools import islice
+import numpy as np
+from multiprocessing import shared_memory
+from utils.json_writer import CHUNK_SIZE
+
+
+# header of a shared block: number of records and size of the packed JSON lines
+_HEADER = np.dtype([("num_rows", np.int64), ("data_size", np.int64)])
+
+
+# The rows of a frame serialized once as JSON lines and addressed by their position, so that processes
+# writing split files can decode just the rows they need. share() copies the lines and their offsets into
+# a shared memory block, which worker processes attach to by name instead of receiving a pickled frame.
+class SharedRecords:
+
+    def __init__(self, offsets, data, shm=None, owner=False):
+        self.offsets = offsets
+        self.data = data
+        self.shm = shm
+        self.owner = owner
+
+    @classmethod
+    def from_frame(cls, frame, chunk_size=CHUNK_SIZE):
+        # serialized a chunk of rows at a time, so that only the packed lines are held in full
+        return cls.from_chunks(frame.iloc[start:start + chunk_size].to_json(orient="records", lines=True).encode("utf-8")
+                               for start in range(0, len(frame), chunk_size))
+
+    @classmethod
+    def from_lines(cls, lines, chunk_size=CHUNK_SIZE):
+        lines = iter(lines)
+        chunks = iter(lambda: "".join(line + "\n" for line in islice(lines, chunk_size)).encode("utf-8"), b"")
+        return cls.from_chunks(chunks)
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        # chunks of JSON lines, each line holding one record
+        data = bytearray()
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for chunk in chunks:
+            if chunk and not chunk.endswith(b"\n"):
+                chunk += b"\n"
+            offsets.append(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")) + len(data) + 1)
+            data += chunk
+        return cls(np.concatenate(offsets).astype(np.int64), memoryview(data))
+
+    @classmethod
+    def _from_buffer(cls, shm, owner):
+        header = np.frombuffer(shm.buf, dtype=_HEADER, count=1)[0]
+        num_rows, data_size = int(header["num_rows"]), int(header["data_size"])
+        offsets = np.frombuffer(shm.buf, dtype=np.int64, count=num_rows + 1, offset=_HEADER.itemsize)
+        start = _HEADER.itemsize + offsets.nbytes
+        return cls(offsets, shm.buf[start:start + data_size], shm, owner)
+
+    @classmethod
+    def attach(cls, name):
+        return cls._from_buffer(shared_memory.SharedMemory(name=name), owner=False)
+
+    def share(self):
+        size = _HEADER.itemsize + self.offsets.nbytes + len(self.data)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        np.frombuffer(shm.buf, dtype=_HEADER, count=1)[0] = (len(self), len(self.data))
+        start = _HEADER.itemsize + self.offsets.nbytes
+        shm.buf[_HEADER.itemsize:start] = self.offsets.tobytes()
+        shm.buf[start:start + len(self.data)] = self.data
+        return SharedRecords._from_buffer(shm, owner=True)
+
+    @property
+    def name(self):
+        return None if self.shm is None else self.shm.name
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, row):
+        # drop the trailing newline of the line
+        return json.loads(bytes(self.data[self.offsets[row]:self.offsets[row + 1] - 1]))
+
+    def records(self, rows):
+        for row in rows:
+            yield self.record(row)
+
+    def close(self):
+        if self.shm is None:
+            return
+        # the views into the block have to be released before it can be closed
+        self.offsets = self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
@@ -1,53 +1,82 @@
 
 import re
 import os
-from utils import big_bracket_pattern, angle_bracket_pattern
+from functools import lru_cache
+from utils import big_bracket_pattern, angle_bracket_pattern, function_pattern, count_variable_pattern, \
+    variable_pattern, count_call_pattern, filter_call_pattern, t_number_pattern, or_pattern, uri_pattern
 from rdflib.plugins.sparql import parser
-from collections import deque
+from collections import deque, Counter
 from rdflib.plugins.sparql.parserutils import CompValue
 from rdflib.plugins.sparql.algebra import translateQuery
+from utils.fast_sparql import extract_triples_fast
 
+# the order in which the comparison operators are listed among the functions
+COMPARATORS = ["<", "<=", ">", ">=", "!="]
 
+# number of queries handled by the fast path and by the rdflib fallback in this process
+fast_path_stats = Counter()
 
-def get_functions_from_sparql(sparql):
-    functions = []
-    # count function
-    count_pattern = re.compile("(?:COUNT|count)")
-    count_strings = count_pattern.findall(sparql)
-    if count_strings and len(count_strings) > 0:
-        functions.append("count")
-    # comparative functions
-    lt_pattern = re.compile("\ <\ ")
-    lt_strings = lt_pattern.findall(sparql)
-    if lt_strings and len(lt_strings) > 0:
-        lt_strings = [lt.strip() for lt in lt_strings if lt.strip() == "<"]
-        functions.extend(lt_strings)
-    lq_pattern = re.compile("\ <=\ ")
-    lq_strings = lq_pattern.findall(sparql)
-    if lq_strings and len(lq_strings) > 0:
-        lq_strings = [lq.strip() for lq in lq_strings if lq.strip() == "<="]
-        functions.extend(lq_strings)
-    gt_pattern = re.compile("\ >\ ")
-    gt_strings = gt_pattern.findall(sparql)
-    if gt_strings and len(gt_strings) > 0:
-        gt_strings = [gt.strip() for gt in gt_strings if gt.strip() == ">"]
-        functions.extend(gt_strings)
-    ge_pattern = re.compile("\ >=\ ")
-    ge_strings = ge_pattern.findall(sparql)
-    if ge_strings and len(ge_strings) > 0:
-        ge_strings = [ge.strip() for ge in ge_strings if ge.strip() == ">="]
-        functions.extend(ge_strings)
-    neq_pattern = re.compile("\ !=\ ")
-    neq_strings = neq_pattern.findall(sparql)
-    if neq_strings and len(neq_strings) > 0:
-        neq_strings = [neq.strip() for neq in neq_strings if neq.strip() == "!="]
-        functions.extend(neq_strings)
+# number of normalized LC-QuAD 2.0 queries kept per process, templates repeat a lot in the data set
+NORMALIZE_CACHE_SIZE = 1 << 16
+
+# namespaces of the wikidata form of the LC-QuAD 2.0 queries
+LCQUAD2_WIKIDATA_PREFIXES = """
+            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#> 
+            PREFIX wd: <http://www.wikidata.org/entity/> 
+            PREFIX wdt: <http://www.wikidata.org/prop/direct/> 
+            PREFIX p: <http://www.wikidata.org/prop/direct/> 
+            PREFIX ps: <http://www.wikidata.org/prop/direct/> 
+            PREFIX pq: <http://www.wikidata.org/prop/direct/>
+        """
+
+# namespaces stripped from the where clause by formalize_for_lcquad2, in this order
+LCQUAD2_STRIPPED_PREFIXES = ["<http://dbpedia.org/resource/", "<http://dbpedia.org/property/",
+                             "<http://dbpedia.org/ontology/", "<http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+                             "<http://www.wikidata.org/entity/", "<http://wikidata.dbpedia.org/resource/",
+                             ">",
+                             "http://dbpedia.org/resource/", "http://dbpedia.org/property/",
+                             "http://dbpedia.org/ontology/", "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+                             "http://www.wikidata.org/entity/", "http://wikidata.dbpedia.org/resource/"]
 
+
+def get_functions_from_sparql(sparql):
+    found = function_pattern.findall(sparql)
+    functions = ["count"] if "" in found else []
+    comparators = [comparator for comparator in found if comparator]
+    if len(comparators) > 1:
+        comparators = _non_overlapping_comparators(sparql)
+    for comparator in COMPARATORS:
+        functions.extend([comparator] * comparators.count(comparator))
     if len(functions) == 0:
         functions.append("none")
     return functions
 
 
+def _non_overlapping_comparators(sparql):
+    # an occurrence of a comparator is skipped if its leading space is the trailing space of the
+    # previous occurrence of the same comparator (e.g. " < < "), as every operator used to be
+    # counted with its own non-overlapping findall
+    comparators = []
+    last_end = dict.fromkeys(COMPARATORS, -1)
+    for match in function_pattern.finditer(sparql):
+        comparator = match.group(1)
+        if comparator and match.start() >= last_end[comparator]:
+            comparators.append(comparator)
+            last_end[comparator] = match.end() + 1
+    return comparators
+
+
+def get_functions_batch(sparqls):
+    # duplicated queries are common, so every distinct query is only scanned once
+    functions = dict()
+    result = []
+    for sparql in sparqls:
+        if sparql not in functions:
+            functions[sparql] = get_functions_from_sparql(sparql)
+        result.append(list(functions[sparql]))
+    return result
+
+
 def get_triples_grailqa(query, pattern=None):
     return _filter_extracted_triples(extract_triples(query), pattern=pattern)
 
@@ -64,13 +93,8 @@ def get_triples_cwq(query, pattern=None):
     """
     query = prefixes + query
     # replace COUNT() with COUNT () to avoid parsing error
-    pattern_1 = re.compile("(?:COUNT|count)\(\?[a-zA-Z0-9]+\)")
-    count_strings = pattern_1.findall(query)
-    if count_strings and len(count_strings) != 0:
-        for count_string in count_strings:
-            pattern_2 = re.compile("\?[a-zA-Z0-9]+")
-            variable = pattern_2.findall(count_string)[0]
-            query = query.replace(count_string, variable)
+    for count_string in count_variable_pattern.findall(query):
+        query = query.replace(count_string, variable_pattern.search(count_string).group(0))
     return _filter_extracted_triples(extract_triples(query), pattern=pattern)
 
 
@@ -78,7 +102,7 @@ def add_missing_angle_brackets_lcquad2(query):
     where_clause = re.search(big_bracket_pattern, query).group(0)
     where_clause = where_clause.strip("{").strip("}")
     where_clause = where_clause.strip(" ")
-    uris = re.findall(r'https?://[^\s<>"]+|www\.[^\s<>"]+', where_clause)
+    uris = uri_pattern.findall(where_clause)
     for uri in uris:
         start_pos = query.find(uri)
         s_pre = query[start_pos - 1]
@@ -87,21 +111,45 @@ def add_missing_angle_brackets_lcquad2(query):
     return query
 
 
+def _independent(replacements):
+    # whether no replacement can affect another one: no old string within or overlapping another one,
+    # nor within a new string or across its boundaries
+    for i, (old, new) in enumerate(replacements):
+        if not old or not new:
+            return False
+        for j, (other, other_new) in enumerate(replacements):
+            if i == j:
+                continue
+            if old in other or old in other_new or new[0] in other or new[-1] in other:
+                return False
+            if any(old.endswith(other[:k]) for k in range(1, min(len(old), len(other)))):
+                return False
+    return True
+
+
+def _replace_all(text, replacements):
+    # the same as applying text.replace(old, new) for every (old, new) pair in order, in a single
+    # substitution when the replacements are independent
+    if not replacements:
+        return text
+    if not _independent(replacements):
+        for old, new in replacements:
+            text = text.replace(old, new)
+        return text
+    new_strings = dict(replacements)
+    alternatives = "|".join(re.escape(old) for old in sorted(new_strings, key=len, reverse=True))
+    return re.sub(alternatives, lambda match: new_strings[match.group(0)], text)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def formalize_for_lcquad2(sparql):
-    prefixes = ["<http://dbpedia.org/resource/", "<http://dbpedia.org/property/",
-                "<http://dbpedia.org/ontology/", "<http://www.w3.org/1999/02/22-rdf-syntax-ns#",
-                "<http://www.wikidata.org/entity/", "<http://wikidata.dbpedia.org/resource/",
-                ">"]
-    prefixes_2 = ["http://dbpedia.org/resource/", "http://dbpedia.org/property/",
-                "http://dbpedia.org/ontology/", "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
-                "http://www.wikidata.org/entity/", "http://wikidata.dbpedia.org/resource/"]
-    where_clause = re.search(big_bracket_pattern, sparql).group(0)
+    where_clause = big_bracket_pattern.search(sparql).group(0)
     left, right = sparql.replace(where_clause, "###").split("###")
     where_clause = where_clause.strip("{").strip("}")
     where_clause = where_clause.strip(" ")
 
-    uris_1 = re.findall(r'https?://[^\s<>"]+|www\.[^\s<>"]+', where_clause)
-    uris_2 = re.findall(angle_bracket_pattern, where_clause)
+    uris_1 = uri_pattern.findall(where_clause)
+    uris_2 = angle_bracket_pattern.findall(where_clause)
     uris = list(set(uris_1+uris_2))
     id2links = dict()
     errors = []
@@ -117,9 +165,7 @@ def formalize_for_lcquad2(sparql):
         else:
             errors.append(uri)
 
-    for p in prefixes:
-        where_clause = where_clause.replace(p, "")
-    for p in prefixes_2:
+    for p in LCQUAD2_STRIPPED_PREFIXES:
         where_clause = where_clause.replace(p, "")
 
     for err in errors:
@@ -127,72 +173,51 @@ def formalize_for_lcquad2(sparql):
 
     triples = [x.strip(" ") for x in where_clause.split(".")]
     new_where_clause = " . ".join([triple for triple in triples])
-    for id, link in id2links.items():
-        if id in ["subject", "predicate", "object"]:
-            new_where_clause = new_where_clause.replace(id, "<" + link + "#" + id + ">")
-        else:
-            new_where_clause = new_where_clause.replace(id, "<" + link + "/" + id + ">")
+    new_where_clause = _replace_all(new_where_clause, [
+        (id, "<" + link + ("#" if id in ["subject", "predicate", "object"] else "/") + id + ">")
+        for id, link in id2links.items()])
 
     new_query = left + "{ " + new_where_clause + " }" + right
     return new_query
 
 
-def get_triples_lcquad2(query, kb, pattern=None):
-
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_lcquad2(query, kb):
+    # the rewrites that let rdflib parse an LC-QuAD 2.0 query, computed once per distinct query
     if kb == "wikidata":
-        prefixes = """
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#> 
-            PREFIX wd: <http://www.wikidata.org/entity/> 
-            PREFIX wdt: <http://www.wikidata.org/prop/direct/> 
-            PREFIX p: <http://www.wikidata.org/prop/direct/> 
-            PREFIX ps: <http://www.wikidata.org/prop/direct/> 
-            PREFIX pq: <http://www.wikidata.org/prop/direct/>
-        """
-
-        query = prefixes + query
+        query = LCQUAD2_WIKIDATA_PREFIXES + query
 
         # ASK WHERE { wd:Q3591475 wdt:P2630 ?obj FILTER (?obj = t1270953452) }
         # error occurs when parsing the above query as t1270953452 is not the correct keyword
-        pattern_1 = re.compile("t[0-9]+")
-        matches = pattern_1.findall(query)
-        if len(matches) != 0:
-            for match in matches: query=query.replace(match, "'{}'".format(match))
+        for match in t_number_pattern.findall(query):
+            query = query.replace(match, "'{}'".format(match))
 
     # replace COUNT() with COUNT () to avoid parsing error
-    pattern_2 = re.compile("(?:COUNT\(|count\()")
-    count_strings = pattern_2.findall(query)
-    if count_strings and len(count_strings) != 0:
-        for count_string in count_strings:
-            query = query.replace(count_string, count_string[:-1] + " (")
+    query = count_call_pattern.sub(lambda match: match.group(0)[:-1] + " (", query)
 
     # # remove FILTER() with FILTER () to avoid parsing error
-    pattern_3 = re.compile("(?:FILTER\(|filter\()")
-    filter_strings = pattern_3.findall(query)
-    if filter_strings and len(filter_strings) != 0:
-        for filter_string in filter_strings:
-            query = query.replace(filter_string, filter_string[:-1]+" (")
-    return _filter_extracted_triples(extract_triples(query), pattern=pattern)
+    query = filter_call_pattern.sub(lambda match: match.group(0)[:-1] + " (", query)
+    return query
+
+
+def get_triples_lcquad2(query, kb, pattern=None, fast=False):
+    return _filter_extracted_triples(_extract_triples(normalize_lcquad2(query, kb), fast), pattern=pattern)
 
 
-def get_triples_lcquad(query, pattern=None):
+def get_triples_lcquad(query, pattern=None, fast=False):
     # replace COUNT() with COUNT () to avoid parsing error
-    pattern_1 = re.compile("(?:COUNT|count)\(\?[a-zA-Z0-9]+\)")
-    count_strings = pattern_1.findall(query)
-    if count_strings and len(count_strings) != 0:
-        for count_string in count_strings:
-            pattern_2 = re.compile("\?[a-zA-Z0-9]+")
-            variable = pattern_2.findall(count_string)[0]
-            query = query.replace(count_string, variable)
-    return _filter_extracted_triples(extract_triples(query), pattern=pattern)
+    for count_string in count_variable_pattern.findall(query):
+        query = query.replace(count_string, variable_pattern.search(count_string).group(0))
+    return _filter_extracted_triples(_extract_triples(query, fast), pattern=pattern)
 
 
 def get_triples_complexwebquestions(query, pattern=None):
     # # replace OR with || to avoid parsing error
-    query = re.sub("\ OR\ ", " || ", query)
+    query = or_pattern.sub(" || ", query)
     return _filter_extracted_triples(extract_triples(query), pattern=pattern)
 
 
-def get_triples_qald(query, pattern=None):
+def get_triples_qald(query, pattern=None, fast=False):
 
     # due to the missing of necessary namespace in the sparql, the parsing error would occur.
     prefixes = """
@@ -216,7 +241,17 @@ def get_triples_qald(query, pattern=None):
         middle = query[query.find("SELECT")+6:query.find("WHERE")]
         if middle != '':
             query = query.replace(middle, " ?uri ")
-    return _filter_extracted_triples(extract_triples(query), pattern=pattern)
+    return _filter_extracted_triples(_extract_triples(query, fast), pattern=pattern)
+
+
+def _extract_triples(query, fast=False):
+    if fast:
+        triples = extract_triples_fast(query)
+        if triples is not None:
+            fast_path_stats["fast"] += 1
+            return triples
+        fast_path_stats["fallback"] += 1
+    return extract_triples(query)
 
 
 def extract_triples(query):
@@ -0,0 +1,161 @@
+from itertools import chain
+import numpy as np
+from utils.lazy import lazy_import
+
+pd = lazy_import("pandas")
+sparse = lazy_import("scipy.sparse")
+
+
+LEVELS = np.array(["zero-shot", "compositional", "i.i.d."], dtype=object)
+ZERO_SHOT, COMPOSITIONAL, IID = 0, 1, 2
+
+
+class SchemaTermIndex:
+    # Interns the schema terms of a data set to ints and keeps the sorted term ids of every
+    # question in CSR layout (indptr/indices), together with the id of the question's term
+    # combination (its sorted multi-set of terms), which serves as the canonical group key of the
+    # question. Questions are addressed by their position in the indexed frame; frames sliced from
+    # it are mapped back through their index labels. The same arrays make up `incidence`, the sparse
+    # questions x terms matrix of term occurrence counts.
+
+    def __init__(self, schema_terms, labels=None):
+        lengths = np.fromiter((len(terms) for terms in schema_terms), dtype=np.int64, count=len(schema_terms))
+        indptr = np.zeros(len(schema_terms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+
+        # term ids in order of first occurrence, then sorted within every row
+        flat = np.empty(indptr[-1], dtype=object)
+        flat[:] = list(chain.from_iterable(schema_terms))
+        codes, terms = pd.factorize(flat)
+        owners = np.repeat(np.arange(len(schema_terms)), lengths)
+        indices = np.sort(owners * max(len(terms), 1) + codes) % max(len(terms), 1)
+
+        self.term2id = {term: i for i, term in enumerate(terms)}
+        self.terms = list(terms)
+        self.indptr = indptr
+        self.indices = indices
+        self.combination_ids, self.num_combinations = self._combination_ids(indptr, indices, owners)
+        self.labels = pd.RangeIndex(len(schema_terms)) if labels is None else pd.Index(labels)
+        self._incidence = None
+
+    @staticmethod
+    def _combination_ids(indptr, indices, owners):
+        # rows padded to the longest one are compared as raw bytes, equal rows are the same combination.
+        # Combinations are numbered in order of first occurrence.
+        num_rows = len(indptr) - 1
+        if num_rows == 0:
+            return np.empty(0, dtype=np.int64), 0
+        width = max(int(np.diff(indptr).max()), 1)
+        padded = np.full((num_rows, width), -1, dtype=np.int64)
+        padded[owners, np.arange(len(indices)) - indptr[owners]] = indices
+        rows = padded.view(np.dtype((np.void, padded.dtype.itemsize * width))).ravel()
+        combination_ids, combinations = pd.factorize(rows)
+        return combination_ids.astype(np.int64), len(combinations)
+
+    @classmethod
+    def from_frame(cls, data):
+        return cls(data["schema_terms"].tolist(), data.index)
+
+    def __len__(self):
+        return len(self.combination_ids)
+
+    @property
+    def num_terms(self):
+        return len(self.terms)
+
+    @property
+    def incidence(self):
+        if self._incidence is None:
+            data = np.ones(len(self.indices), dtype=np.int64)
+            self._incidence = sparse.csr_matrix((data, self.indices, self.indptr), shape=(len(self), self.num_terms))
+        return self._incidence
+
+    def term_counts(self, rows):
+        # occurrences of every term in the given rows
+        return np.asarray(self.incidence[np.asarray(rows, dtype=np.int64)].sum(axis=0)).ravel()
+
+    def unseen_counts(self, rows, unseen):
+        # the number of term occurrences of every row that are unseen, an int64 indicator per term
+        return self.incidence[np.asarray(rows, dtype=np.int64)] @ unseen
+
+    def positions(self, frame):
+        positions = self.labels.get_indexer(frame.index)
+        if (positions < 0).any():
+            raise KeyError("frame contains questions that are not in the index")
+        return positions
+
+    def row_lengths(self, rows):
+        return self.indptr[rows + 1] - self.indptr[rows]
+
+    def term_ids(self, rows):
+        # flat term ids of the given rows, one run of ids per row
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.row_lengths(rows)
+        starts = np.repeat(self.indptr[rows] - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[starts + np.arange(lengths.sum())]
+
+    def vocabulary(self, rows=None):
+        vocabulary = TermVocabulary(self)
+        if rows is not None:
+            vocabulary.add(rows)
+        return vocabulary
+
+    def classify(self, rows, vocabulary):
+        # the level of every row w.r.t. the train set the vocabulary was built from,
+        # following the rules of resplit.determine_level
+        rows = np.asarray(rows, dtype=np.int64)
+        has_unseen = self.unseen_counts(rows, (vocabulary.term_counts == 0).astype(np.int64)) > 0
+
+        levels = np.where(has_unseen, ZERO_SHOT, COMPOSITIONAL)
+        levels[vocabulary.combination_counts[self.combination_ids[rows]] > 0] = IID
+        return levels
+
+    def classify_frame(self, data, train_set=None, vocabulary=None):
+        if vocabulary is None:
+            vocabulary = self.vocabulary(self.positions(train_set))
+        return LEVELS[self.classify(self.positions(data), vocabulary)]
+
+
+class TermVocabulary:
+    # Occurrence counts of the terms and term combinations of a train set, so that rows can be
+    # added to or removed from the train set without recounting it from scratch.
+
+    def __init__(self, index):
+        self.index = index
+        self.term_counts = np.zeros(index.num_terms, dtype=np.int64)
+        self.combination_counts = np.zeros(index.num_combinations, dtype=np.int64)
+
+    def __contains__(self, term):
+        term_id = self.index.term2id.get(term)
+        return term_id is not None and self.term_counts[term_id] > 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.term_counts))
+
+    def copy(self):
+        vocabulary = TermVocabulary.__new__(TermVocabulary)
+        vocabulary.index = self.index
+        vocabulary.term_counts = self.term_counts.copy()
+        vocabulary.combination_counts = self.combination_counts.copy()
+        return vocabulary
+
+    def _update(self, rows, sign):
+        rows = np.asarray(rows, dtype=np.int64)
+        self.term_counts += sign * np.bincount(self.index.term_ids(rows), minlength=self.index.num_terms)
+        self.combination_counts += sign * np.bincount(self.index.combination_ids[rows], minlength=self.index.num_combinations)
+
+    def add(self, rows):
+        self._update(rows, 1)
+        return self
+
+    def remove(self, rows):
+        self._update(rows, -1)
+        if (self.term_counts < 0).any():
+            raise ValueError("removed rows that are not part of the vocabulary")
+        return self
+
+    def add_frame(self, frame):
+        return self.add(self.index.positions(frame))
+
+    def remove_frame(self, frame):
+        return self.remove(self.index.positions(frame))
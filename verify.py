@@ -0,0 +1,145 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+from array import array
+from collections import Counter
+import numpy as np
+from resplit import determine_level
+from utils.dataset_sources import iter_json_array
+
+# Checks resplitted data sets without regenerating them: every valid/test question must not be in the
+# train file (same id) and its level must be the one determine_level assigns against the train file.
+# The files are streamed, only the train vocabulary, its term combinations and a hash of every train id
+# are kept in memory, e.g.
+#   python verify.py --split_dir output_dir/lcquad/new_split output_dir/qald/new_split
+
+
+HELDOUT_SPLITS = ["valid", "test"]
+
+
+def iter_questions(path):
+    # the questions of a json/compact split (the {"dataset": ..., "questions": [...]} envelope or a bare
+    # array) or of a jsonl split, one at a time
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    with open(path, encoding="utf-8") as f:
+        first = f.read(1024).lstrip()[:1]
+    yield from iter_json_array(path, key=None if first == "[" else "questions")
+
+
+def id_hash(id):
+    # 8 bytes per train question, a collision between two of n ids has a probability of about n^2 / 2^65
+    return int.from_bytes(hashlib.blake2b(str(id).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def find_split_files(split_dir):
+    # {split: path} of the <dataset_id>-<split>.json(l) files written by resplit.py
+    files = dict()
+    for path in sorted(glob.glob(os.path.join(split_dir, "*.json")) + glob.glob(os.path.join(split_dir, "*.jsonl"))):
+        split = os.path.splitext(os.path.basename(path))[0].rsplit("-", 1)[-1]
+        if split in ["train"] + HELDOUT_SPLITS:
+            files[split] = path
+    return files
+
+
+class TrainVocabulary:
+    # the interned terms, term combinations (sorted multi-sets of term ids) and id hashes of a train file
+
+    def __init__(self):
+        self.term2id = dict()
+        self.combinations = set()
+        self.id_hashes = array("Q")
+
+    def add(self, question):
+        term_ids = [self.term2id.setdefault(term, len(self.term2id)) for term in question["schema_terms"]]
+        self.combinations.add(tuple(sorted(term_ids)))
+        self.id_hashes.append(id_hash(question["id"]))
+
+    def freeze(self):
+        self.id_hashes = np.unique(np.frombuffer(self.id_hashes, dtype=np.uint64))
+
+    def combination(self, schema_terms):
+        # terms not in train get -1, such a combination is never one of train
+        return tuple(sorted(self.term2id.get(term, -1) for term in schema_terms))
+
+    def contains_id(self, id):
+        position = np.searchsorted(self.id_hashes, np.uint64(id_hash(id)))
+        return position < len(self.id_hashes) and self.id_hashes[position] == np.uint64(id_hash(id))
+
+    def level(self, schema_terms):
+        # the term dict stands in for the set of train terms, set.difference only looks terms up in it
+        return determine_level(schema_terms, self.combination(schema_terms), self.term2id, self.combinations)
+
+
+def verify_split(split_dir, max_reported=10):
+    # prints the checks of a split directory, returns the number of problems found
+    files = find_split_files(split_dir)
+    if "train" not in files:
+        print(f"{split_dir}: no train file")
+        return 1
+
+    start = time.perf_counter()
+    vocabulary = TrainVocabulary()
+    num_train = 0
+    for question in iter_questions(files["train"]):
+        vocabulary.add(question)
+        num_train += 1
+    vocabulary.freeze()
+    seconds = time.perf_counter() - start
+    print(f"{files['train']}: {num_train} questions, {len(vocabulary.term2id)} terms, "
+          f"{len(vocabulary.combinations)} combinations ({seconds:.2f} s, {num_train / max(seconds, 1e-9):.0f} questions/s)")
+
+    # the first max_reported faulty questions of the valid and test files together are listed
+    problems, listed = 0, 0
+    for split in HELDOUT_SPLITS:
+        if split not in files:
+            continue
+        start = time.perf_counter()
+        num_questions, leaked, mismatches, levels = 0, 0, Counter(), Counter()
+        for question in iter_questions(files[split]):
+            num_questions += 1
+            level = vocabulary.level(question["schema_terms"])
+            levels[level] += 1
+            reported = []
+            if vocabulary.contains_id(question["id"]):
+                leaked += 1
+                reported.append("also in train")
+            if question.get("level") != level:
+                mismatches[(question.get("level"), level)] += 1
+                reported.append(f"labelled {question.get('level')}, is {level}")
+            if reported and listed < max_reported:
+                listed += 1
+                print(f"  {question['id']}: {', '.join(reported)}")
+        seconds = time.perf_counter() - start
+        problems += leaked + sum(mismatches.values())
+        print(f"{files[split]}: {num_questions} questions ({', '.join(f'{n} {level}' for level, n in sorted(levels.items()))}), "
+              f"{leaked} in train, {sum(mismatches.values())} wrong levels "
+              f"({seconds:.2f} s, {num_questions / max(seconds, 1e-9):.0f} questions/s)")
+        for (labelled, level), n in sorted(mismatches.items(), key=str):
+            print(f"  {n} labelled {labelled} are {level}")
+    return problems
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split_dir", nargs="+", required=True, type=str, help="directories with the train/valid/test files of a split.")
+    parser.add_argument("--max_reported", default=10, type=int, help="the number of faulty questions listed per split directory.")
+    args = parser.parse_args(arguments)
+
+    problems = 0
+    for split_dir in args.split_dir:
+        problems += verify_split(split_dir, args.max_reported)
+    print(f"{problems} problems found")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))